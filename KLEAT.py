@@ -11,8 +11,25 @@ import sys
 import re
 import subprocess
 import shutil
+import multiprocessing
+import itertools
+import cStringIO
 # External modules below
 import pysam
+import numpy as np
+# In house modules below
+from annotation import load_feature_dict, TranscriptSeqs, TranscriptIndex, STRAND_CODES
+from reference import ReferenceCache
+from journal import Journal, JournalError
+from prefetch import Prefetcher
+from prescreen import load_clip_counts, RULES
+from readsummary import ContigReads, summarise_contigs
+from sidecar import ReadsSidecar, SidecarError, default_sidecar_path
+from polya import polyA_tails, good_bridge_reads, classify_clipped
+from sequence import reverse_complement, reverse_complements
+from profiling import Profiler
+import results
+from results import output_fields, calcScore, report_results, write_partial, align_bridge_reads, write_results, bridge_read_queries
 
 parser = argparse.ArgumentParser(description='this program tries to find polya cleavage sites through short-read assembly.it is expected that contigs are aligned to contigs, and reads aligned to contigs. these 2 alignment steps can be performed by trans-abyss. the aligners used are gmap for contig-genome and bwa-sw for read-contig alignments. annotations files for ensembl, knowngenes, refseq, and aceview are downloaded from ucsc. est data(optional) are also downloaded from ucsc. the analysis can be composed of 2 phases: 1. contig-centric phase - cleavage sites per contig are captured 2. coordinate-centric phase - contigs capturing the same cleavage site are consolidated into 1 report where expression/evidence-related data are summed. customized filtering based on evidence data can be performed.')
 parser.add_argument('c2g', metavar='<contig-to-genome>', help='The contig-to-genome alignment file in bam format.')
@@ -30,14 +47,33 @@ parser.add_argument('--max_diff', help='Maximum rate of x to y bases allowed in
 parser.add_argument('--max_diff_link', help='Maximum number of non A|T bases in entire link read. Default is 2.', type=int, default=2)
 parser.add_argument('--max_poor_bases_in_bridge_read', metavar='[x] [y]', type=float, help='Filter out bridge reads that have >= [x] poor-quality bases. [y] is the minimum quality. Qualities range from 33-126 lowest to highest quality respectively. Default is: 0 35', default=[0,35], nargs=2)
 parser.add_argument('--min_bridge_size', help='Minimum size of bridge. Default is 1.', type=int, default=1)
-parser.add_argument('--max_dist', help='The maximum distance that a putative cleavage site may be from an annotated end. Default is 5000', default=5000)
+parser.add_argument('--max_dist', type=int, help='The maximum distance that a putative cleavage site may be from an annotated end. Default is 5000', default=5000)
 parser.add_argument('-k', '--track', metavar=('[name]','[description]'), help='Name and description of BED graph track to output.', nargs=2)
 parser.add_argument('--rgb', help='RGB value of BED graph. Default is 0,0,255', default='0,0,255')
 parser.add_argument('-c', help='Specify a contig/s to look at.', nargs='+')
+parser.add_argument('--region', action='append', help='Only look at contigs aligned to this region of the genome, given as chr, chr:start-end or a BED file. Can be given more than once. Needs an indexed contig-to-genome BAM file.')
+parser.add_argument('--tail_coverage', type=int, metavar='[window]', help='Add a tail_coverage column with the number of unclipped reads spanning each contig position within this distance of the last matched base of each tail or bridge, separated by colons.')
+parser.add_argument('--sweep', nargs='+', metavar='param=values', help='Evaluate every combination of the given values of --min_at, --max_diff, --trim, --max_poor_bases_in_bridge_read and --min_bridge_size in one pass, e.g. --sweep min_at=3,4,5 max_diff=1:5,1:3 (the two values of --max_diff and --max_poor_bases_in_bridge_read are separated by a colon). The other parameters keep their values. Writes <output-file>.sweep<N>.KLEAT and .stats for combination N, listed in <output-file>.sweep.tsv.')
 parser.add_argument('--link', action='store_true', help='Enable searching for cleavage site link evidence. This will substantially increase runtime.')
 parser.add_argument('--limit', type=int, help='Only look at the first this number of contigs')
+parser.add_argument('--annot_cache', help='Path of the binary annotation cache. Default is <annotations>.kleat_cache')
+parser.add_argument('--no_annot_cache', action='store_true', help='Always parse the annotations file instead of using the binary cache.')
+parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from its journal (<output-file>.journal), skipping contigs already analysed. The journal is deleted once a run has written its results.')
+parser.add_argument('--prescreen', action='store_true', help='Skip the tail and bridge read search for contigs whose ends and reads are all unclipped, or that have no transcript end within --max_dist. Clipped reads are counted once per reads-to-contigs file into <reads-to-contigs>.kleat_clips.')
+parser.add_argument('--prefetch', type=int, default=8, help='Number of contigs whose sequence and reads are loaded ahead by a background thread. 0 disables prefetching. Default is 8.')
+parser.add_argument('--stream_r2c', action='store_true', help='Read the reads-to-contigs file once, sequentially, summarising the reads of every contig to analyse before the analysis, instead of fetching the reads of each contig from it. The file then needs no index, but the summaries of all contigs are held in memory.')
+parser.add_argument('--sidecar', nargs='?', const='', metavar='[sidecar]', help='Read the reads of each contig from a sidecar file written by KLEAT_extract.py instead of the reads-to-contigs file, which must be the one it was extracted from. Default sidecar is <reads-to-contigs>.kleat_reads')
+parser.add_argument('--emit-partial', dest='emit_partial', action='store_true', help='Stop before the bridge read alignment and write the results to <output-file>.partial, to be merged with those of other runs by KLEAT_merge.py. Runs should be split with --region where no transcript crosses the region boundaries.')
+parser.add_argument('--profile', action='store_true', help='Write the time and number of calls of each stage, the fetches through each pysam handle and the slowest contigs to <output-file>.profile.json, instead of printing the time of each contig.')
+parser.add_argument('--profile_top', type=int, default=20, help='Number of slowest contigs listed by --profile. Default is 20.')
+parser.add_argument('-p', '--processes', type=int, default=1, help='Number of worker processes used to analyse contigs. Default is 1.')
+parser.add_argument('--blat_threads', type=int, default=1, help='Number of blat processes run at once to align the potential bridge reads. Above 1 the reads are split into this many chunks, each aligned against the genome and the transcripts in its own process. Default is 1.')
 
 args = parser.parse_args()
+if args.tail_coverage is not None:
+    output_fields.append('tail_coverage')
+# Stage timings and fetch counts (profiler)
+profiler = Profiler(top=args.profile_top) if args.profile else None
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('polyA_logger')
@@ -48,7 +84,7 @@ logger = logging.getLogger('polyA_logger')
 
 # Reference genome sequence (refseq)
 logger.debug("Loading reference genome via pysam 0.8.1")
-refseq = pysam.FastaFile(args.ref_genome)
+refseq = ReferenceCache(pysam.FastaFile(args.ref_genome))
 logger.debug("Reference genome successfully loaded!")
 
 # Contigs to genome alignments (aligns)
@@ -65,61 +101,42 @@ else:
 # Contig sequences
 contigs = pysam.FastaFile(args.contigs)
 
-# Features (features)
-features = pysam.TabixFile(args.annot, parser=pysam.asGTF())
-
 # Feature dictionary
-feature_dict = {}
-f = pysam.tabix_iterator(open(args.annot),parser=pysam.asGTF())
-for c in f:
-    chrom = c.contig
-    tid = c.asDict()['transcript_id']
-    if chrom not in feature_dict:
-        feature_dict[chrom] = {}
-    if tid not in feature_dict[chrom]:
-        feature_dict[chrom][tid] = {'feats':[c], 'cstart':None, 'cend':None, 
-                                    'i':0, 'start_codon': None, 'stop_codon': None,
-                                    'tstart': c.start, 'tend': c.end, 'utr3': [], 'utr5': [],
-                                    'strand': None, 'cleavage_sites': [], 'seq': None}
-    else:
-        feature_dict[chrom][tid]['feats'].append(c)
-    current = feature_dict[chrom][tid]
-    if (not current['strand']):
-        current['strand'] = c.strand
-    if (c.end >= current['tend']):
-        current['tend'] = c.end
-    if (c.feature == 'CDS') and (not current['cstart']):
-        current['cstart'] = c.start
-    elif (c.feature == 'CDS'):
-        current['cend'] = c.end
-    if (c.feature == 'start_codon'):
-        current['start_codon'] = current['i']
-    elif (c.feature == 'stop_codon'):
-        current['stop_codon'] = current['i']
-    current['i'] += 1
-
-
-# Go through the feature_dict and try to determine 3utrs and 5utrs
-for chrom in feature_dict:
-    for tid in feature_dict[chrom]:
-        current = feature_dict[chrom][tid]
-#        if not current['cstart']:
-#            current['cstart'] = current['tstart']
-#        if not current['cend']:
-#            current['cend'] = current['tend']
-        current['seq'] = ('').join([refseq.fetch(x.contig,x.start,x.end).upper() for x in current['feats'] if x.feature =='exon'])
-        if (current['feats'][0].strand == '+'):
-            if (current['cend']) and (current['tend'] > current['cend']+3):
-                # Plus 3 to first coordinate to account for stop codon
-                current['utr3'] = [current['cend']+3,current['tend']]
-        else:
-            if (current['cstart']) and (current['tstart'] < (current['cstart']-3)):
-                # Minus 3 to last coordinate to account for stop codon
-                current['utr3'] = [current['tstart'],current['cstart']-3]
+annot_start = time.time()
+feature_dict = load_feature_dict(args.annot, cache_path=args.annot_cache, use_cache=not args.no_annot_cache)
+
+# Transcripts indexed by their genomic span (transcript_index)
+transcript_index = TranscriptIndex(feature_dict)
+if profiler:
+    profiler.add_stage('annotation load', time.time() - annot_start)
+
+# Transcript sequences, only built for transcripts that need them
+transcript_seqs = TranscriptSeqs(feature_dict, refseq)
 
 # Reads to contigs alignment (r2c)
 r2c = pysam.AlignmentFile(args.r2c, "rb")
 
+# Read summaries extracted from the reads to contigs alignment (reads_sidecar)
+reads_sidecar = None
+if args.sidecar is not None:
+    if args.stream_r2c:
+        sys.exit("--sidecar and --stream_r2c can't be used together. Exiting.")
+    if not args.sidecar:
+        args.sidecar = default_sidecar_path(args.r2c)
+    try:
+        reads_sidecar = ReadsSidecar(args.sidecar, args.r2c)
+    except SidecarError as e:
+        sys.exit("{}, run KLEAT_extract.py {} first. Exiting.".format(e, args.r2c))
+
+# Number of clipped reads per contig (clip_counts), for the pre-screen
+clip_counts = None
+if args.prescreen:
+    clip_counts = reads_sidecar.clip_counts() if reads_sidecar else load_clip_counts(args.r2c)
+# Contigs screened and eliminated by each pre-screen rule (prescreen_counts)
+prescreen_counts = dict.fromkeys(RULES, 0)
+# With --stream_r2c, {contig: [alignments left to analyse, read summary]} (read_summaries)
+read_summaries = None
+
 def int_to_base_qual(qual_int, offset):
     """Converts integer to base quality base"""
     if offset == 64 or offset == 33:
@@ -133,9 +150,10 @@ if args.trim_reads:
         if poor_qual is not None:
             poor_quals += poor_qual
 
-output_fields=['gene','transcript','transcript_strand','coding','contig','chromosome','cleavage_site','within_UTR','distance_from_annotated_site','ESTs','length_of_tail_in_contig','number_of_tail_reads','number_of_bridge_reads','max_bridge_read_tail_length','bridge_read_identities','tail+bridge_reads','number_of_link_pairs','max_link_pair_length','link_pair_identities','hexamer_loc+id','3UTR_start_end']
 if args.c:
     args.out += '.'+('_').join(args.c)
+    # hashed for the per alignment lookup
+    args.c = set(args.c)
 prefix = os.path.splitext(args.out)[0]
 basedir = os.path.dirname(args.out)
 if not os.path.exists(basedir):
@@ -147,19 +165,14 @@ shutil.copy(os.path.realpath(__file__),basedir)
 potential_bridges = open(os.path.join(basedir,'.potential_bridges'), 'w')
 extended = open(os.path.join(basedir,'.extended'), 'w')
 
-transcript_seqs = open(args.out+'.transcript_seqs','w')
-for chrom in feature_dict:
-    for tid in feature_dict[chrom]:
-        current = feature_dict[chrom][tid]
-        transcript_seqs.write('>{}\n{}\n'.format(tid,current['seq']))
-transcript_seqs.close()
-
 # Filters (filters)
 global_filters = {}
 global_filters['min_at'] = int(args.min_at)
 global_filters['max_diff'] = [int(x) for x in args.max_diff]
 global_filters['max_diff_link'] = args.max_diff_link
 global_filters['min_bridge_size'] = args.min_bridge_size
+global_filters['trim_reads'] = args.trim_reads
+global_filters['max_poor_bases_in_bridge_read'] = args.max_poor_bases_in_bridge_read
 global_filters['feature_dict'] = feature_dict
 global_filters['hexamer_colours'] = ["255,0,0", "255,100,100", "255,150,150", "255,200,200",
                                      "0,255,0", "100,255,100", "150,255,150", "200,255,200",
@@ -171,6 +184,55 @@ global_filters['binding_sites'] = ['AATAAA','ATTAAA','AGTAAA','TATAAA',
                                    'AATGAA','TTTAAA','AAAACA','GGGGCT']
 global_filters['all_results'] = {}
 
+# Parameters --sweep can vary: option name, filter key and value parser
+SWEEP_PARAMS = [('min_at', 'min_at', int),
+                ('max_diff', 'max_diff', lambda x: [int(y) for y in x.split(':')]),
+                ('trim', 'trim_reads', int),
+                ('max_poor_bases_in_bridge_read', 'max_poor_bases_in_bridge_read', lambda x: [float(y) for y in x.split(':')]),
+                ('min_bridge_size', 'min_bridge_size', int)]
+
+def parse_sweep(specs):
+    """Parses --sweep values into the filters of each parameter combination
+
+    Each combination gets a copy of global_filters with its values, and the
+    cleavage sites it adds to transcripts ('cleavage_sites', {(chrom, tid):
+    cleavage sites}) so that combinations don't see each other's sites
+    """
+    params = dict((x[0], x[1:]) for x in SWEEP_PARAMS)
+    names, values = [], []
+    for spec in specs:
+        name, _, spec_values = spec.partition('=')
+        if name not in params or name in names or not spec_values:
+            sys.exit("Bad --sweep parameter {}, give one of {} as param=values. Exiting.".format(spec, ', '.join(x[0] for x in SWEEP_PARAMS)))
+        key, parse = params[name]
+        try:
+            spec_values = [parse(x) for x in spec_values.split(',')]
+        except ValueError:
+            sys.exit("Bad --sweep values {}. Exiting.".format(spec))
+        if any(isinstance(x, list) and len(x) != 2 for x in spec_values):
+            sys.exit("Bad --sweep values {}, {} takes two values separated by a colon. Exiting.".format(spec, name))
+        names.append(name)
+        values.append(spec_values)
+    filters = []
+    for combination in itertools.product(*values):
+        gf = dict(global_filters)
+        for name, value in zip(names, combination):
+            gf[params[name][0]] = value
+        gf['cleavage_sites'] = {}
+        filters.append(gf)
+    return filters
+
+# Filters of each --sweep parameter combination (sweep)
+sweep = None
+if args.sweep:
+    if args.emit_partial:
+        sys.exit("--sweep and --emit-partial can't be used together. Exiting.")
+    sweep = parse_sweep(args.sweep)
+
+# Cleavage sites added to transcripts while analysing the current contig,
+# journaled so that a resumed run can restore them (cleavage_site_log)
+cleavage_site_log = []
+
 def ucsc_chroms(genome):
     """Extracts conversion of UCSC chromosome names
     eg. hg19"""
@@ -186,31 +248,6 @@ def ucsc_chroms(genome):
     return conversions
 
 
-def compare_chr(chr1, chr2):
-    """For sorting chromosome names ignoring 'chr'"""
-    if chr1[:3].lower() == 'chr':
-        chr1 = chr1[3:]
-    if chr2[:3].lower() == 'chr':
-        chr2 = chr2[3:]
-    
-    if re.match('^\d+$', chr1) and not re.match('^\d+$', chr2):
-        return -1
-    
-    elif not re.match('^\d+$', chr1) and re.match('^\d+$', chr2):
-        return 1
-    
-    else:
-        if re.match('^\d+$', chr1) and re.match('^\d+$', chr2):
-            chr1 = int(chr1)
-            chr2 = int(chr2)
-            
-        if chr1 < chr2:
-            return -1
-        elif chr1 > chr2:
-            return 1
-        else:
-            return 0
-
 def get_coding_type(transcript):
     """Returns transcript type: CODING/NONCODING/NA
     CODING when cdsStart != cdsEnd
@@ -219,285 +256,11 @@ def get_coding_type(transcript):
     #    times[key].append(time.time()-start)
     return 'unknown'
     #elif transcript['cstart'] and transcript['cend'] and (transcript['cstart'] != transcript['cend']):
-    if transcript['cstart'] and transcript['cend']:
+    if transcript.cstart and transcript.cend:
         return 'yes'
     else:
         return 'no'
 
-def cantorPairing(a,b):
-    return (0.5*(a+b)*(a+b+1))+b
-
-def group_and_filter(lines_result, out_file, filters=None, make_track=None, rgb='0,0,0'):
-    #print 'grouping and filtering'
-    #print 'lines_result: {}'.format(lines_result)
-    global output_fields
-    hexamer_colours = ["255,0,0", "255,100,100", "255,150,150", "255,200,200",
-                       "0,255,0", "100,255,100", "150,255,150", "200,255,200",
-                       "0,0,255", "100,100,255", "150,150,255", "200,200,255",
-                       "255,0,255", "255,100,255", "255,150,255", "255,200,255"]
-    binding_sites = ['AATAAA','ATTAAA','AGTAAA','TATAAA',
-                     'CATAAA','GATAAA','AATATA','AATACA',
-                     'AATAGA','AAAAAG','ACTAAA','AAGAAA',
-                     'AATGAA','TTTAAA','AAAACA','GGGGCT']
-    """Consolidates contig-centric results into coordinate-centric results
-    
-    path = directory of tab-delimited results files
-    """
-    groups = {}
-    
-    lines_result = [x.split('\t') for x in lines_result.splitlines()]
-    for cols in lines_result:
-        chrom, cleavage_site = cols[5], cols[6]
-        if not groups.has_key(chrom):
-            groups[chrom] = {}
-        if not groups[chrom].has_key(cleavage_site):
-            groups[chrom][cleavage_site] = []
-        groups[chrom][cleavage_site].append(cols)
-            
-    stats = {'gene': {},
-             'transcript': {'coding': {}, 'noncoding':{}, 'unknown': {}},
-             'screened_out': 0,
-             'cleavage_site': 0,
-             'with_tail': 0,
-             'tail_and_bridge_and_link': 0,
-             'tail_and_bridge': 0,
-             'tail_and_link': 0,
-             'bridge_and_link': 0,
-             'just_tail': 0,
-             'just_bridge': 0,
-             'just_link': 0,
-             }
-            
-    out = open(out_file, 'w')
-    out.write('%s\n' % '\t'.join(output_fields))
-    
-    track_plus = []
-    track_minus = []
-    hexamers = []
-    utrs = []
-    uniqueutrs = set()
-    uniquehexamers = {}
-    for chrom in sorted(groups.keys(), cmp=compare_chr):
-        for cleavage in sorted(groups[chrom].keys()):
-            results = groups[chrom][cleavage]
-            # if more than one contig reports same cleavage site, add up the support numbers
-            if len(results) > 1:
-                result = merge_results(results)
-            else:
-                result = results[0]
-            if (result[10] != '-') and (result[12] != '-') and (result[16] != '-'):
-                if (int(result[10]) == 0) and (int(result[12]) == 0) and (int(result[16]) == 0):
-                    continue
-            
-            if ('-' not in [result[12],result[13]]):
-            #if (result[12] != '-'):
-                if (filters) and ('min_bridge_size' in filters) and ((int(result[12]) > 0) and (int(result[13]) < filters['min_bridge_size'])):
-                    continue
-                
-            out.write('%s\n' % '\t'.join(result))
-            if make_track is not None:
-                if result[2] == '+':
-                    track_plus.append(show_expression(result))
-                    for thing in show_hexamer(result,binding_sites,hexamer_colours):
-                        
-                        hexamers.append(thing)
-                else:
-                    track_minus.append(show_expression(result))
-                    for thing in show_hexamer(result,binding_sites,hexamer_colours):
-                        hexamers.append(thing)
-
-                utr = show_utr(result)
-                if utr:
-                    #print 'utr: {}'.format(utr)
-                    a,b = [int(x) for x in utr.split('\t')[1:3]]
-                    pairing = cantorPairing(a,b)
-                    if pairing not in uniqueutrs:
-                        utrs.append(utr)
-                        uniqueutrs.add(pairing)
-            
-            # stats
-            update_stats(stats, result)
-                
-    out.close()
-        
-    # prefix used for track and stats files
-    prefix = os.path.splitext(out_file)[0]
-    # output track
-    #randstr = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(10))
-    if make_track is not None:
-        track_file = prefix + '.bg'
-        output_track2(prefix+'.+.bg', make_track[0]+'.+', make_track[1], rgb, track_plus)
-        output_track2(prefix+'.-.bg', make_track[0]+'.-', make_track[1], rgb, track_minus)
-        output_hexamer(prefix + '.HEXAMERS.bed', hexamers)
-        output_track_utr(prefix+'.3UTR.bed', make_track[0]+'.3UTRs', make_track[1], rgb, utrs)
-        
-    # output stats file
-    stats_file = prefix + '.stats'
-    output_stats(stats, stats_file)
-
-def prepare_track_header(name, desc, rgb):
-    """Creates header for track"""
-    return 'track type=bedGraph name="%s" description="%s" visibility=full color=%s' % (name, desc, rgb)
-
-def output_hexamer(out_file, track=[]):
-    out = open(out_file, 'w')
-    out.write('track name="hexamer_track" description="Track containing all CPSF hexamer binding sites" visibility=2 itemRgb="On"\n')
-    for line in track:
-        out.write('%s\n' % line)
-    out.close()
-
-def output_track_utr(out_file, name, desc, rgb, track=[]):
-    out = open(out_file, 'w')
-    out.write('track name="{}" description="3\'UTR" visibility=full itemRgb="On"\n'.format(name, rgb))
-    for line in track:
-        out.write('{}\n'.format(line))
-
-def output_track2(out_file, name, desc, rgb, track=[]):
-    out = open(out_file, 'w')
-    out.write('track type=bedGraph name="{}" description="{}" visibility=full color={}\n'.format(name, desc, rgb))
-    for line in track:
-        out.write('{}\n'.format(line))
-
-def merge_results(results):        
-    """Merges results from different contigs of same cleavage site into single result"""
-    # join fields: contig, bridge_name, link_name
-    join = [4, 14, 18]              
-    # add fields: num_tail_reads, num_bridge_reads, tail+bridge, num_link_pairs
-    add = [11, 12, 15, 16]
-    # max fields: tail_len, bridge_len, link_len
-    biggest = [10, 13, 17]
-    
-    merged = []
-    for i in range(len(results[0])):
-        if i in add:
-            data = [int(r[i]) for r in results if r[i].isdigit()]
-            if data:
-                merged.append(str(sum(data)))
-            else:
-                merged.append('-')              
-        elif i in biggest:
-            data = [int(r[i]) for r in results if r[i].isdigit()]
-            if data:
-                merged.append(str(max(data)))
-            else:
-                merged.append('-')              
-        elif i in join:
-            data = [r[i] for r in results if r[i] != '-']
-            
-            # if there is data other than '-', then list all items
-            if data:
-                merged.append(','.join([r[i] for r in results if r[i] != '-']))
-            else:
-                merged.append('-')                  
-        else:
-            merged.append(results[0][i])
-
-    return merged
-
-def update_stats(stats, result):
-    """Updates summary stats with result
-    
-    stats = dictionary of final stats results
-    result = list of values of each output line
-    """
-    has_tail = has_bridge = has_link = False
-    if result[10].isdigit() and int(result[10]) > 0:
-        has_tail = True
-    if result[12].isdigit() and int(result[12]) > 0:
-        has_bridge = True
-    if result[16].isdigit() and int(result[16]) > 0:
-        has_link = True
-        
-    if not (has_tail or has_bridge or has_link):
-        return
-        
-    stats['cleavage_site'] += 1
-    
-    if not stats['gene'].has_key(result[0]):
-        stats['gene'][result[0]] = 0
-    stats['gene'][result[0]] += 1
-    
-    if result[3] == 'yes':
-        stats['transcript']['coding'][result[1]] = True
-    elif result[3] == 'no':
-        stats['transcript']['noncoding'][result[1]] = True
-    else:
-        stats['transcript']['unknown'][result[1]] = True
-                        
-    if has_tail and has_bridge and has_link:
-        stats['tail_and_bridge_and_link'] += 1
-    elif has_tail and has_bridge:
-        stats['tail_and_bridge'] += 1
-    elif has_bridge and has_link:
-        stats['bridge_and_link'] += 1
-    elif has_tail and has_link:
-        stats['tail_and_link'] += 1
-    elif has_tail:
-        stats['just_tail'] += 1
-    elif has_bridge:
-        stats['just_bridge'] += 1
-    elif has_link:
-        stats['just_link'] += 1
-
-def output_stats(stats, out_file):
-    """Outputs stats data into output file"""
-    out = open(out_file, 'w')
-    out.write('total cleavage sites: %d\n' % stats['cleavage_site'])
-    out.write('cleavage sites with tail, bridge, link support: %d\n' % stats['tail_and_bridge_and_link'])
-    out.write('cleavage sites with tail, bridge support: %d\n' % stats['tail_and_bridge'])
-    out.write('cleavage sites with tail, link support: %d\n' % stats['tail_and_link'])
-    out.write('cleavage sites with bridge, link support: %d\n' % stats['bridge_and_link'])
-    out.write('cleavage sites with only tail support: %d\n' % stats['just_tail'])
-    out.write('cleavage sites with only bridge support: %d\n' % stats['just_bridge'])
-    out.write('cleavage sites with only link support: %d\n' % stats['just_link'])
-    out.write('total genes: %d\n' % len(stats['gene'].keys()))
-    try:
-        out.write('average cleavage sites per gene: %.1f\n' % (float(stats['cleavage_site'])/len(stats['gene'].keys())))
-    except ZeroDivisionError:
-        out.write('average cleavage sites per gene: error')
-    out.write('total transcripts: %d\n' % (len(stats['transcript']['coding'].keys()) + len(stats['transcript']['noncoding'].keys())))
-    out.write('total coding transcripts: %d\n' % len(stats['transcript']['coding'].keys()))
-    out.write('total noncoding transcripts: %d\n' % len(stats['transcript']['noncoding'].keys()))
-    out.close()
-
-
-def show_expression(result):
-    """Creates bed-graph line depicting expression of cleavage site"""
-    return '%s\t%s\t%s\t%s' % (result[5], int(result[6]) - 1, result[6], result[15])
-
-def show_hexamer(result, binding_sites, rbgs):
-    r = []
-    sites = result[19].split(';')
-    sites = [x.split(':') for x in sites]
-    for site in reversed(sites):
-        if len(site) < 2:
-            break
-        if result[2] == '+':
-            r.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], site[0], int(site[0])+6, binding_sites[int(site[1])-1], int(site[1])*62.5, result[2], site[0], int(site[0])+6, rbgs[int(site[1])-1]))
-        else:
-            r.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], int(site[0])-6, site[0], binding_sites[int(site[1])-1], int(site[1])*62.5, result[2], int(site[0])-6, site[0], rbgs[int(site[1])-1]))
-    return r
-
-def show_utr(result):
-#    print 'show_utr'
-#    print 'result: {}'.format(result)
-    if result[20] == '-':
-        return None
-    start, end = result[20].split('-')
-    if (start == 'None') or (end == 'None'):
-        return None
-    rgb='255,0,0'
-    if result[20][0] == 'N':
-        start = start[1:]
-        rgb='0,255,0'
-    #if result[2] == '-':
-    #    times[key].append(time.time()-start)
-    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], end, start, result[4], 0, result[2], end, start, rgb)
-    #else:
-    #    times[key].append(time.time()-start)
-    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], start, end, result[4], 0, result[2], start, end, rgb)
-    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], start, end, result[4], 0, result[2], start, end, rgb)
-
 # chrom_proper
 chrom_proper = ucsc_chroms(args.ref_genome)
 
@@ -565,29 +328,7 @@ def is_polyA_tail(seq, expected_base, min_len, max_nonAT_allowed):
                              per stretch of M bases
     """
     #print '{}\t{}\t{}\t{}'.format(seq,expected_base,min_len,max_nonAT_allowed)
-    result = True
-
-    if seq is None or seq == '' or expected_base is None or not expected_base in seq:
-        return False
-        
-    # minimum number of As or Ts
-    freq = check_freq(seq)
-    #print freq
-    if freq[expected_base] < min_len:
-        return False
-
-    if (max_nonAT_allowed[0] == 0):
-        if (freq[expected_base] < len(seq)):
-            return False
-        
-    non_base = sum([freq[b] for b in freq if b != expected_base])
-    if (non_base == 0):
-        return True
-    ratio = float(freq[expected_base])/non_base
-    #print 'ratio: {}'.format(ratio)
-    #print 'max_nonAT: {}'.format(max_nonAT_allowed[1]/max_nonAT_allowed[0])
-    if (ratio < max_nonAT_allowed[1]/max_nonAT_allowed[0]):
-        return False
+    result = polyA_tails([seq], expected_base, min_len, max_nonAT_allowed)[0]
 
 #    for i in range(0, len(seq), max_nonAT_allowed[1]):
 #        subseq = seq[i:i+10]
@@ -655,12 +396,8 @@ def cigarToBlocks(cigar, tstart, strand):
     return tblocks, qblocks
 
 def revComp(seq):
-    seq = seq.upper()
-    ndic = {'A':'T','T':'A','C':'G','G':'C','N':'N'}
-    revcomp = ''
-    for nuc in seq:
-        revcomp += ndic[nuc]
-    return revcomp[::-1]
+    """Reverse complement of seq in upper case"""
+    return reverse_complement(seq, upper=True)
 
 def getQueryBlocks(align):
     query_blocks = []
@@ -765,13 +502,10 @@ def is_bridge_read_good(clipped_seq, base, min_len, mismatch):
     If clipped_seq is composed of base only, then it is automatically 
     considered a potential bridge read regardless of length
     Otherwise will check the frequecy of 'the other bases' using is_polyA_tail()
+    (both as polya.good_bridge_reads decides for many sequences at once)
     to determine whether it's acceptable
     """
-    good = False
-    if clipped_seq[0].upper() == base and len(re.sub(r'(.)\1+', r'\1', clipped_seq)) == 1:
-        good = True
-    elif is_polyA_tail(clipped_seq, base, min_len=min_len, max_nonAT_allowed=mismatch):
-        good = True
+    good = good_bridge_reads([clipped_seq], base, min_len, mismatch)[0]
     #if good:
         #print '{}-{}'.format(clipped_seq, good)
     return good
@@ -784,30 +518,30 @@ def trim_bases(seq, qual, end=None):
     if poor_quals is None or poor_quals == '':
         return seq
     
-    match_end = match_start = None
-    match_end = re.search(r'[%s]+$' % poor_quals, qual)            
-    match_start = re.search(r'^[%s]+' % poor_quals, qual)
+    # lengths of the runs of poor quality bases at either end
+    poor_start = len(qual) - len(qual.lstrip(poor_quals))
+    poor_end = len(qual) - len(qual.rstrip(poor_quals))
     
-    if match_start and not match_end:
+    if poor_start and not poor_end:
         if end is None or end == 'start':
-            return seq[match_start.end():]
+            return seq[poor_start:]
         
-    elif match_end and not match_start:
+    elif poor_end and not poor_start:
         if end is None or end == 'end':
-            return seq[:match_end.start()]
+            return seq[:len(seq) - poor_end]
         
-    elif match_start and match_end:
+    elif poor_start and poor_end:
         if end == 'start':
-            return seq[match_start.end():]
+            return seq[poor_start:]
         
         elif end == 'end':
-            return seq[:match_end.start()]
+            return seq[:len(seq) - poor_end]
         
         else:
-            if len(match_start.group()) > len(match_end.group()):
-                return seq[match_start.end():]
-            elif len(match_end.group()) > len(match_start.group()):
-                return seq[:match_end.start()]
+            if poor_start > poor_end:
+                return seq[poor_start:]
+            elif poor_end > poor_start:
+                return seq[:len(seq) - poor_end]
     
     return seq
 
@@ -844,7 +578,7 @@ def output_link_pairs(align, reads):
                                                      mate_contig, num_trimmed_bases, trimmed_seq) 
     return out
 
-def annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, min_txt_match_percent=0.6):
+def annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, min_txt_match_percent=0.6, cleavage_sites=None):
     """Finds transcript where proposed cleavage site makes most sense, and also fetches matching ESTs
 
     This method assesses whether the cleavage site makes sense with
@@ -867,6 +601,9 @@ def annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, min_txt_matc
     
     If no trancript can be found given the clipped postion, clipped base, and alignment, it will
     return None
+
+    The cleavage sites found are added to the transcripts, or to cleavage_sites
+    ({(chrom, tid): cleavage sites}) if given
     """     
     result = None
     
@@ -890,54 +627,49 @@ def annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, min_txt_matc
        (txt_strand == '-' and base == 'T'):     
         ests = []
         
-        txts_screened = a['tids']
-        flength = len(txts_screened)
-        for tid in txts_screened:
-            if fd[chrom][tid]['strand'] != txt_strand:
-                flength -= 1
-#        print '{}\t{}'.format(cleavage_site,flength)
-
-        if flength == 0:
+        table = transcript_index.tables[a['target']]
+        close = a['close']
+        # No overlapping transcript on the strand the cleavage site comes from
+        if not np.any(table['strand'][close['rows']] == STRAND_CODES[txt_strand]):
             return result
         
         within_utr, identical = False,False
         closest_tid = None
         min_dist = 9000000
-        closest = None
-        #print 'cleavage_site: {}'.format(cleavage_site)
 
+        # Order transcripts by the distance of their end to the cleavage site,
+        # ties keep the order of the distance to the contig end
         if a['strand'] == '+':
-            closest = sorted(a['close'],key=lambda(x):abs(cleavage_site - fd[a['target']][x[0]]['tend']))
-            #for i in xrange(len(closest)):
-                #closest[i][1] = abs(cleavage_site - closest[i][2].end)
+            ends = table['tend'][close['rows']]
         else:
-            closest = sorted(a['close'],key=lambda(x):abs(cleavage_site - fd[a['target']][x[0]]['tstart']))
-            #for i in xrange(len(closest)):
-                # Plus one because pysam grabs 1 before the actual start
-                #closest[i][1] = abs(cleavage_site - closest[i][2].start + 1)
-        #print 'closest: {}'.format(closest)
-        #raw_input('*')
-        if not closest:
+            ends = table['tstart'][close['rows']]
+        closest = np.argsort(np.abs(cleavage_site - ends), kind='mergesort')
+        if not len(closest):
             return result
-        closest_within_utr3 = [x for x in closest if x[-1]]
-        if closest_within_utr3 and (closest_within_utr3[0][1] <= 20):
+        closest_within_utr3 = closest[close['has_utr3'][closest]]
+        if len(closest_within_utr3) and (close['dist'][closest_within_utr3[0]] <= 20):
             closest = closest_within_utr3[0]
         else:
             closest = closest[0]
-        if a['strand'] == '+':
-            min_dist = abs(cleavage_site - fd[a['target']][closest[0]]['tend'])
-        else:
-            min_dist = abs(cleavage_site - fd[a['target']][closest[0]]['tend'])
-        closest_tid = closest[0]
-        if closest[1] == 0:
+        min_dist = int(abs(cleavage_site - table['tend'][close['rows'][closest]]))
+        closest_tid = table['tid'][close['rows'][closest]]
+        if close['dist'][closest] == 0:
             identical = True
-        if fd[a['target']][closest_tid]['utr3']:
+        if fd[a['target']][closest_tid].utr3:
             within_utr = True
 
-        if (min_dist <= thresh_dist) or (any([abs(cleavage_site - x) <= thresh_dist for x in fd[a['target']][closest_tid]['cleavage_sites']])):
+        if cleavage_sites is None:
+            known_sites = fd[a['target']][closest_tid].get_cleavage_sites()
+        else:
+            known_sites = cleavage_sites.get((a['target'], closest_tid), [])
+        if (min_dist <= thresh_dist) or (any([abs(cleavage_site - x) <= thresh_dist for x in known_sites])):
             a['report_closest'] = False
 
-        fd[a['target']][closest_tid]['cleavage_sites'].append(cleavage_site)
+        if cleavage_sites is None:
+            fd[a['target']][closest_tid].add_cleavage_site(cleavage_site)
+        else:
+            cleavage_sites.setdefault((a['target'], closest_tid), []).append(cleavage_site)
+        cleavage_site_log.append((a['target'], closest_tid, cleavage_site))
 
         result = {
                 'ests': ests,
@@ -958,7 +690,6 @@ def annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, min_txt_matc
     return result
 
 def find_polyA_cleavage(a,gf,fd):
-    gf = global_filters
     """Finds PolyA cleavage sites of a given aligned contig
     
     This method first checks if the given contig captures a polyA tail (find_tail_contig),
@@ -979,7 +710,7 @@ def find_polyA_cleavage(a,gf,fd):
         for event in tail[clipped_pos]:
             # contig coordinate of cleavage site                
             last_matched, cleavage_site, base, tail_seq, num_tail_reads, bridge_reads, bridge_clipped_seq = event
-            result = annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd)
+            result = annotate_cleavage_site(a, cleavage_site, clipped_pos, base, fd, cleavage_sites=gf.get('cleavage_sites'))
             if result:
                 if bridge_reads:
                     result['num_bridge_reads'] = len(bridge_reads)
@@ -990,6 +721,8 @@ def find_polyA_cleavage(a,gf,fd):
                 result['clipped_pos'] = clipped_pos
                 result['tail_seq'] = tail_seq
                 result['num_tail_reads'] = num_tail_reads
+                if args.tail_coverage is not None:
+                    result['tail_coverage'] = a['reads'].coverage(last_matched, args.tail_coverage)
                 results.append(result)
     return results
 
@@ -1088,101 +821,116 @@ def find_bridge_reads(a, min_len, mismatch, gf, genome_buffer=1000, tail=None):
     # identify clipped reads that are potential pA/pT
     clipped_reads = {'start':{}, 'end':{}}
     second_round = {'start':[], 'end':[]}
+    # clipped reads whose clipped sequence is to be checked for a tail
+    candidates = []
+    # Experimental feature
+    mpb = gf['max_poor_bases_in_bridge_read']
+    cutoff = mpb[0]*mpb[1]
+    trim_reads = gf['trim_reads']
+    # quality of all clipped reads at once
+    if a['reads'].clipped:
+        # kept in a for the other filters of a sweep
+        if 'qualities' not in a:
+            a['qualities'] = a['reads'].clipped_qualities()
+            a['poor_sums'], a['poor_runs'] = {}, {}
+        if mpb[1] not in a['poor_sums']:
+            a['poor_sums'][mpb[1]] = a['qualities'].poor_quality_sums(mpb[1])
+        poor_sums = a['poor_sums'][mpb[1]]
+        if trim_reads:
+            # poor quality bases at the start and end of each read, for trimming
+            if trim_reads not in a['poor_runs']:
+                a['poor_runs'][trim_reads] = a['qualities'].poor_runs(trim_reads)
+            poor_start, poor_end = a['poor_runs'][trim_reads]
     #for read in self.bam.bam.fetch(align.query):
-    for read in r2c.fetch(a['align'].query_name):
+    for i, read in enumerate(a['reads'].clipped):
 #        print 'read: {}'.format(read.qname)
-        if not read.cigar or len(read.cigar) != 2:
+        # clipped at start
+        if read.cigar[0][0] == 4 or read.cigar[0][0] == 5:
+            clipped_pos = 'start'
+            #print read
+            #test = raw_input('Press any key to continue')
+            last_matched = read.pos + 1
+            # to see whether the clipped seq is a pA tail
+            clipped_seq = read.seq[:read.cigar[0][1]]
+            
+        # clipped at end
+        else:
+            clipped_pos = 'end'
+            last_matched = read.pos + read.alen
+            # to see whether the clipped seq is a pA tail
+            clipped_seq = read.seq[-1 * read.cigar[-1][1]:]
+            
+        #print 'sum: {}'.format(poor_sums[i])
+        #print 'cutoff: {}'.format(cutoff)
+        if poor_sums[i] > cutoff:
             continue
-        if (read.cigar[0][0] == 4 or read.cigar[0][0] == 5) or\
-           (read.cigar[-1][0] == 4 or read.cigar[-1][0] == 5):
-            # clipped at start
-            if read.cigar[0][0] == 4 or read.cigar[0][0] == 5:
-                clipped_pos = 'start'
-                #print read
-                #test = raw_input('Press any key to continue')
-                last_matched = read.pos + 1
-                # to see whether the clipped seq is a pA tail
-                clipped_seq = read.seq[:read.cigar[0][1]]
-                # for trimming of poor quality bases if so descired
-                clipped_qual = read.qual[:read.cigar[0][1]]
-                
-            # clipped at end
+        # if last_match is beyond the limit of the alignment, adjust last_matched
+        if last_matched < query_bounds[0] or last_matched > query_bounds[1]:
+            if last_matched < query_bounds[0]:
+                diff = query_bounds[0] - last_matched
             else:
-                clipped_pos = 'end'
-                last_matched = read.pos + read.alen
-                # to see whether the clipped seq is a pA tail
-                clipped_seq = read.seq[-1 * read.cigar[-1][1]:]
-                # for trimming of poor quality bases if so descired
-                clipped_qual = read.qual[-1 * read.cigar[-1][1]:]
-                
-            #print 'read:\n{}\n{}'.format(read.qname,read.qual)
-            # Experimental feature
-            mpb = args.max_poor_bases_in_bridge_read
-            cutoff = mpb[0]*mpb[1]
-            #print 'sum: {}'.format(sum([ord(x) for x in read.qual if ord(x) <= mpb[1]]))
-            #print 'cutoff: {}'.format(cutoff)
-            if sum([ord(x) for x in read.qual if ord(x) <= mpb[1]]) > cutoff:
-                continue
-            # if last_match is beyond the limit of the alignment, adjust last_matched
-            if last_matched < query_bounds[0] or last_matched > query_bounds[1]:
-                if last_matched < query_bounds[0]:
-                    diff = query_bounds[0] - last_matched
-                else:
-                    diff = last_matched - query_bounds[1]
-                if clipped_pos == 'start':
-                    last_matched = last_matched + diff
-                    clipped_seq = read.seq[:read.cigar[0][1] + diff]
-                    clipped_qual = read.qual[:read.cigar[0][1] + diff]
-                else:
-                    last_matched = last_matched - diff
-                    clipped_seq = read.seq[-1 * (read.cigar[-1][1] + diff):]
-                    clipped_qual = read.qual[-1 * (read.cigar[-1][1] + diff):]
-                                    
-            # trim poor quality base if desired
+                diff = last_matched - query_bounds[1]
+            if clipped_pos == 'start':
+                last_matched = last_matched + diff
+                clipped_seq = read.seq[:read.cigar[0][1] + diff]
+            else:
+                last_matched = last_matched - diff
+                clipped_seq = read.seq[-1 * (read.cigar[-1][1] + diff):]
+                                
+        # trim poor quality base if desired
 #            print read.qname
-            #print 'clipped_seq pre-trim: {}'.format(clipped_seq)
-            if args.trim_reads:
-                clipped_seq = trim_bases(clipped_seq, clipped_qual, clipped_pos)
-            #print 'clipped_seq post-trim: {}'.format(clipped_seq)
-                
-            #print '{}\t{}\t{}\t{}'.format(read.qname,read.cigar,read.seq,read.is_reverse)
-            if len(clipped_seq) < 1:
-                continue
-            if (len(clipped_seq) < global_filters['min_bridge_size']):
-                continue
-            
-            # reverse complement to be in agreement with reference instead of contig
-            clipped_seq_genome = clipped_seq
-            if a['strand'] == '-':
-                clipped_seq_genome = revComp(clipped_seq)
-            #print clipped_seq_genome
+        #print 'clipped_seq pre-trim: {}'.format(clipped_seq)
+        # (the clipped sequence is a prefix or suffix of the read, so its poor
+        # quality run is the read's, up to the length of the clipped sequence)
+        if trim_reads:
+            if clipped_pos == 'start':
+                clipped_seq = clipped_seq[min(poor_start[i], len(clipped_seq)):]
+            else:
+                clipped_seq = clipped_seq[:len(clipped_seq) - min(poor_end[i], len(clipped_seq))]
+        #print 'clipped_seq post-trim: {}'.format(clipped_seq)
             
-            # check for possible tail (stretch of A's or T's)
-            pos_genome = qpos_to_tpos(a, last_matched)
-            #print 'pos_genome:\n{}'.format(pos_genome)
-            picked = False
-            #print 'clipped_seq_genome:\n{}'.format(clipped_seq_genome)
-            for base in ('A', 'T'):
-                #print 'base: {}'.format(base)
-                #print 'min_len: {}'.format(min_len)
-                #print 'mismatch: {}'.format(mismatch)
-                #raw_input('*'*20)
-                #print '{}\t{}\t{}\t{}'.format(read.qname,base,clipped_pos,clipped_seq_genome)
-                if is_bridge_read_good(clipped_seq_genome, base, min_len, mismatch):
+        #print '{}\t{}\t{}\t{}'.format(read.qname,read.cigar,read.seq,read.is_reverse)
+        if len(clipped_seq) < 1:
+            continue
+        if (len(clipped_seq) < gf['min_bridge_size']):
+            continue
+        
+        pos_genome = qpos_to_tpos(a, last_matched)
+        #print 'pos_genome:\n{}'.format(pos_genome)
+        candidates.append((read, clipped_pos, last_matched, clipped_seq, pos_genome))
+
+    # reverse complement to be in agreement with reference instead of contig
+    if a['strand'] == '-' and candidates:
+        clipped_seqs_genome = reverse_complements([x[3] for x in candidates], upper=True)
+        candidates = [x[:3] + (seq,) + x[4:] for x, seq in zip(candidates, clipped_seqs_genome)]
+        #print clipped_seqs_genome
+
+    # check for possible tail (stretch of A's or T's), all clipped sequences at once
+    good = classify_clipped([x[3] for x in candidates], min_len, mismatch)
+    for i, (read, clipped_pos, last_matched, clipped_seq_genome, pos_genome) in enumerate(candidates):
+        picked = False
+        #print 'clipped_seq_genome:\n{}'.format(clipped_seq_genome)
+        for base in ('A', 'T'):
+            #print 'base: {}'.format(base)
+            #print 'min_len: {}'.format(min_len)
+            #print 'mismatch: {}'.format(mismatch)
+            #raw_input('*'*20)
+            #print '{}\t{}\t{}\t{}'.format(read.qname,base,clipped_pos,clipped_seq_genome)
+            if good[base][0][i]:
 #                    print 'below is good bridge_read'
 #                    print '{}\t{}\t{}\t{}'.format(read.qname,base,clipped_pos,clipped_seq_genome)
-                    if not clipped_reads[clipped_pos].has_key(last_matched):
-                        clipped_reads[clipped_pos][last_matched] = {}
-                    if not clipped_reads[clipped_pos][last_matched].has_key(base):
-                        clipped_reads[clipped_pos][last_matched][base] = []
-                    clipped_reads[clipped_pos][last_matched][base].append([read, clipped_seq_genome, pos_genome])
-                    picked = True
-                    potential_bridges.write('>{}\n{}\n'.format(read.qname,read.seq))#read_name,read_objs[read_name].seq))
-                    
-            if not picked:
-                extended.write('>{}\n{}\n'.format(read.qname,read.seq))
-                second_round[clipped_pos].append(read)
-                #extended.write('>{}\t{}\n{}\n'.format(a['align'].qname, read.qname, read.seq))
+                if not clipped_reads[clipped_pos].has_key(last_matched):
+                    clipped_reads[clipped_pos][last_matched] = {}
+                if not clipped_reads[clipped_pos][last_matched].has_key(base):
+                    clipped_reads[clipped_pos][last_matched][base] = []
+                clipped_reads[clipped_pos][last_matched][base].append([read, clipped_seq_genome, pos_genome])
+                picked = True
+                potential_bridges.write('>{}\n{}\n'.format(read.qname,read.seq))#read_name,read_objs[read_name].seq))
+                
+        if not picked:
+            extended.write('>{}\n{}\n'.format(read.qname,read.seq))
+            second_round[clipped_pos].append(read)
+            #extended.write('>{}\t{}\n{}\n'.format(a['align'].qname, read.qname, read.seq))
     #print 'clipped_reads:\n{}'.format(clipped_reads)
 
     #extended_clipped_reads = find_extended_bridge_reads(a, second_round, min_len, mismatch)
@@ -1293,17 +1041,9 @@ def in_homopolymer_neighbor(chrom, pos, tail, base):
                     
     return False
 
-def get_num_tail_reads(align, last_matched):
+def get_num_tail_reads(a, last_matched):
     """Reports number of reads spanning cleavage site in contig"""
-    num = 0
-    for read in r2c.fetch(align.qname):
-        if not read.cigar or len(read.cigar) != 1:
-            continue
-        
-        if read.pos + 1 <= last_matched and read.pos + read.alen > last_matched:
-            num += 1
-    
-    return num
+    return a['reads'].num_spanning(last_matched)
 
 def find_tail_contig(a, min_len, mismatch):
     """Finds contigs that have polyA tail reconstructed"""
@@ -1359,7 +1099,7 @@ def find_tail_contig(a, min_len, mismatch):
                     #    continue
                     
                     # find reads corresponding to tail
-                    num_tail_reads = get_num_tail_reads(a['align'], last_matched)
+                    num_tail_reads = get_num_tail_reads(a, last_matched)
                                                                     
                     if not results.has_key(clipped_pos):
                         results[clipped_pos] = []
@@ -1452,16 +1192,15 @@ def extract_transcript_seq(align, target, out_file):
     """
     
     chrom = proper_chrom(target, chrom_proper=chrom_proper)
-    feats = features.fetch(chrom, align.reference_start, align.reference_end)
     out = open(out_file, 'w')
     empty = True
     transcripts = {}
-    for feature in feats:
-        if (feature.transcript_id not in transcripts):
-            transcripts[feature.transcript_id] = ''
-        if feature.feature == 'exon':
-            empty = False
-            transcripts[feature.transcript_id] += refseq.fetch(chrom, feature.start, feature.end).upper()
+    for tid in transcript_index.fetch(chrom, align.reference_start, align.reference_end):
+        transcripts[tid] = ''
+        for start, end in feature_dict[chrom][tid].exons:
+            if start < align.reference_end and end > align.reference_start:
+                empty = False
+                transcripts[tid] += refseq.fetch(chrom, start, end).upper()
     for tid in transcripts:
         #print "transcript_seq: {}".format(transcripts[tid])
         out.write('>%s\n%s\n' % (tid, transcripts[tid]))
@@ -1469,26 +1208,6 @@ def extract_transcript_seq(align, target, out_file):
     
     return empty
 
-def calcScore(match, mismatch, qnuminsert, tnuminsert):
-    return int(match) - int(mismatch) - int(qnuminsert) - int(tnuminsert)
-
-def get_blat_aln(aln_file):
-    result = {}
-    with open(aln_file, 'r') as f:
-        for line in f:
-            if not re.search('^\d', line):
-                continue
-            cols = line.rstrip('\n').split('\t')
-            query, qsize, qstart, qend, target = cols[9:14]
-            block_count = cols[17]
-            tstart,tend = cols[15],cols[16]
-            score = calcScore(cols[0],cols[1],cols[4],cols[6])
-            if query not in result:
-                result[query] = [[int(qsize),int(qstart),int(qend),target,int(block_count),score,int(tstart),int(tend)]]
-            else:
-                result[query].append([int(qsize),int(qstart),int(qend),target,int(block_count),score,int(tstart),int(tend)])
-    return result
-
 def get_full_blat_aln(aln_file):
     fully_aligned = {}
     for line in open(aln_file, 'r'):
@@ -1641,8 +1360,8 @@ def output_result(result, output_fields, fd, link_pairs=[]):
 #        data['transcript'] = result['txt']['transcript_id']
 #        data['transcript_strand'] = result['txt']['strand']
     data['transcript'] = result['txt']
-    data['transcript_strand'] = fd[result['a']['target']][result['txt']]['feats'][0].strand
-    data['gene'] = fd[result['a']['target']][result['txt']]['feats'][0].asDict()['gene_id']
+    data['transcript_strand'] = fd[result['a']['target']][result['txt']].strand
+    data['gene'] = fd[result['a']['target']][result['txt']].gene_id
     data['coding'] = get_coding_type(fd[result['a']['target']][result['txt']])
 #    if coding_type == 'CODING':
 #        data['coding'] = 'yes'
@@ -1714,6 +1433,9 @@ def output_result(result, output_fields, fd, link_pairs=[]):
 #        else:
 #            data['3UTR_start_end'] = N+str(utr3['start'])+'-'+str(utr3['end'])
     
+    if 'tail_coverage' in result:
+        data['tail_coverage'] = ':'.join(str(x) for x in result['tail_coverage'])
+
     cols = []
     for field in output_fields:
         if field in data:
@@ -1739,9 +1461,11 @@ def findBindingSites(a, cleavage_site):
     results = []
     if not args.strand_specific:
         seq = refseq.fetch(a['target'],cleavage_site-50,cleavage_site+50).upper()
+        # reverse complement of the window, the hexamer at i is reversed at len(seq)-i-6
+        rev_seq = revComp(seq)
         for i in xrange(len(seq)):
             hexamer = seq[i:i+6]
-            rev = revComp(seq[i:i+6])
+            rev = rev_seq[max(len(seq)-i-6, 0):len(seq)-i]
             if (hexamer in binding_sites):
                 results.append([i+cleavage_site-50,binding_sites[hexamer]])
             if (rev in binding_sites):
@@ -1756,8 +1480,9 @@ def findBindingSites(a, cleavage_site):
                     results.append([i+cleavage_site-50,binding_sites[hexamer]])
         else:
             seq = refseq.fetch(a['target'],cleavage_site,cleavage_site+50)
+            rev_seq = revComp(seq)
             for i in xrange(len(seq)):
-                hexamer = revComp(seq[i:i+6])
+                hexamer = rev_seq[max(len(seq)-i-6, 0):len(seq)-i]
                 if (hexamer in binding_sites):
                     results.append([cleavage_site+i+6,binding_sites[hexamer]])
     # Enable this to fix BTL-513
@@ -1806,129 +1531,134 @@ def binarySearch(sorted_array,val):
     return binarySearch(sorted_array,val)
         
         
-def filter_contig_sites(contig_sites,fd):
-    contig_sites = sorted(contig_sites, key=lambda x: x['cleavage_site'])
-    res = [contig_sites[0]]
-    for event in contig_sites[1:]:
-        if (abs(event['cleavage_site'] - res[-1]['cleavage_site']) > 20):
-            res.append(event)
-    return res
-
 # Short variable for variable containing all result info
 #ar = global_filters['all_results']
 # If the distance between any transcript end and the contig end is
 # less than this value, the transcript end should be reported as a cleavage event
 thresh_dist = 20
-lines_result = lines_bridge = lines_link = ''
-#file_lines_result = open(args.out+'.lr','w')
-#contig_sites_file = open(args.out+'.cs','w')
-contig_sites = []
-for align in aligns:
-    # If contigs are specified only look at those
-    if args.c:
-        if align.query_name not in args.c:
-            continue
-    try:
-        print '{}\t{}'.format(align.qname,time.time()-start)
-    except NameError:
-        start = time.time()
-    start = time.time()
-    #sys.stdout.write('{}-{}-{}{}\r'.format(align.qname,align.reference_start, align.reference_end,'*'*10))
-    #print '{}\t{}\t{}'.format(align.qname,align.reference_start, align.reference_end)
+
+def analyse_contig(align, prefetched=None):
+    """Finds the cleavage sites captured by one contig-to-genome alignment
+
+    prefetched is the (contig sequence, reads) pair loaded by
+    prefetch_contig, they are fetched here when it is None.
+    Returns the contig-centric result lines and the transcript ends
+    reached by the contig (contig_sites)
+    """
+    a = prepare_contig(align, prefetched)
+    if a is None:
+        return '', []
+    return contig_results(a, global_filters)
+
+def prepare_contig(align, prefetched=None):
+    """Finds the transcripts near one contig-to-genome alignment and loads its reads
+
+    Returns the state of the contig (a) the cleavage site search starts
+    from, or None if the alignment is skipped. a['reads'] is None when
+    the pre-screen eliminates the contig.
+    """
     # If the contig has no start or no end coordinate, we can't
     # do any analysis on it, so we must skip it
     if (align.reference_start == None) or (align.reference_end == None):
-        continue
+        return None
     # tids              = Set of transcript ids that overlap contig
     # closest_tid       = Set the closest transcript to the end of the contig
     # report_closest    = Whether to report the closest transcript end as a cs
     # min_dist          = The minimum distance between any transcript and the contig
     a = {'align': align,'closest_tid': None, 'blocks': align.blocks,
          'report_closest': False, 'tids': set(), 'min_dist': 1000000,
-         'utr3s': {}, 'utr5s': {}, 'close':[],'base': None}
+         'utr3s': {}, 'utr5s': {}, 'close': None,'base': None}
     # Get target/chromosome
     a['target'] = aligns.getrname(align.tid)
     # Get the sequence of the contig
-    a['contig_seq'] = contigs.fetch(align.query_name)
+    if prefetched:
+        a['contig_seq'] = prefetched[0]
+    else:
+        a['contig_seq'] = contigs.fetch(align.query_name)
     # Filtering of contigs
     if align.query_alignment_length and len(a['contig_seq']):
         if (float(align.query_alignment_length)/len(a['contig_seq'])) < 0.6:
-            continue
-    # Get the overlapping features
-    try:
-        feats = features.fetch(a['target'], align.reference_start, align.reference_end)
-    # If fails, skip this contig
-    except ValueError:
-        continue
+            return None
+    # If the chromosome has no annotated transcripts, skip this contig
+    if a['target'] not in transcript_index:
+        return None
     # If the library is strand specific, assume the contig strand is correct
     if args.strand_specific:
         if (align.is_reverse):
             a['strand'] = '-'
         elif not (align.is_reverse):
             a['strand'] = '+'
+    # Rows of the overlapping transcripts in the chromosome's transcript table
+    table = transcript_index.tables[a['target']]
+    rows = overlapping_rows(a['target'], align)
     # Store all transcript id's
-    for f in feats:
-        tid = f.asDict()['transcript_id']
-        if (args.strand_specific):
-            if (f.strand != a['strand']):
-                continue
-        a['tids'].add(tid)
+    a['tids'] = set(table['tid'][rows])
     # If not a strand specific library, infer the strand by looking at the overlapping features
     # First, count how many overlapping transcripts are + and -
-    likely_strand = {'-': 0, '+': 0}
-    for tid in a['tids']:
-        likely_strand[feature_dict[a['target']][tid]['strand']] += 1
+    strands = table['strand'][rows]
+    likely_strand = {'-': int(np.sum(strands == STRAND_CODES['-'])), '+': int(np.sum(strands == STRAND_CODES['+']))}
     if not a['strand']:
         a['strand'] = max(likely_strand, key=lambda x: likely_strand[x])
     # If the tid list is empty, skip this contig
     if not a['tids']:
-        continue
-    # Go through the list of transcripts and find the one closest
-    # to the end of the contig
-    for t in a['tids']:
-        has_utr3 = False
-        # If the transcript is of a different strand than the contig, skip it
-        if args.strand_specific:
-            if (feature_dict[a['target']][t]['strand'] != a['strand']):
-                continue
-        if (a['strand'] == '+'):
-            dist = abs(feature_dict[a['target']][t]['tend'] - align.reference_end)
-        else:
-            dist = abs(feature_dict[a['target']][t]['tstart'] - align.reference_start)
-        if feature_dict[a['target']][t]['utr3']:
-            has_utr3 = True
-        a['close'].append([t,dist,has_utr3])
+        return None
+    # Distance between each transcript end and the end of the contig,
+    # transcripts are kept sorted by this distance
+    if (a['strand'] == '+'):
+        dist = np.abs(table['tend'][rows] - align.reference_end)
+    else:
+        dist = np.abs(table['tstart'][rows] - align.reference_start)
+    order = np.argsort(dist, kind='mergesort')
+    a['close'] = {'rows': rows[order], 'dist': dist[order], 'has_utr3': table['has_utr3'][rows[order]]}
     # Get 3utrs for all overlapping transcripts
-    for t in a['tids']:
-        utr3 = feature_dict[a['target']][t]['utr3']
-        if (utr3):
-            a['utr3s'][t] = utr3
-    #a['close'] = [x for x in a['close'] if x[1] < thresh_dist]
-    if (a['close']):
-        a['close'] = sorted(a['close'], key=lambda(x):x[1])
-        #print 'a[close]: {}'.format([[x[0],x[2].start,x[2].end] for x in a['close']])
-        within_utr3 = [x for x in a['close'] if x[-1] and (x[1] <= thresh_dist)]
-        if within_utr3:
-            within_utr3 = within_utr3[0]
-            a['closest_tid'],a['min_dist'] = within_utr3[:-1]
-        else:
-            a['closest_tid'],a['min_dist'] = a['close'][0][:-1]
+    for t in table['tid'][rows[table['has_utr3'][rows]]]:
+        a['utr3s'][t] = feature_dict[a['target']][t].utr3
+    # Prefer the closest transcript with a 3'UTR if its end is close enough to the contig end
+    within_utr3 = np.flatnonzero(a['close']['has_utr3'] & (a['close']['dist'] <= thresh_dist))
+    closest = within_utr3[0] if len(within_utr3) else 0
+    a['closest_tid'] = table['tid'][a['close']['rows'][closest]]
+    a['min_dist'] = int(a['close']['dist'][closest])
     if (a['min_dist'] <= thresh_dist):
         a['report_closest'] = True
     # Skip contig if there is no feature close to it
     if not a['closest_tid']:
-        continue
+        release_reads(align, prefetched)
+        return None
     # Get query blocks
     a['qblocks'] = cigarToBlocks(align.cigar, align.reference_start, a['strand'])[1]
     if not a['qblocks']:
-        continue
+        release_reads(align, prefetched)
+        return None
     a['qstart'] = min(a['qblocks'][0][0], a['qblocks'][0][1], a['qblocks'][-1][0], a['qblocks'][-1][1])
     a['qend'] = max(a['qblocks'][0][0], a['qblocks'][0][1], a['qblocks'][-1][0], a['qblocks'][-1][1])
+    if args.prescreen and not prescreen_contig(a):
+        release_reads(align, prefetched)
+        a['reads'] = None
+    else:
+        # Summary of the reads aligned to the contig
+        if prefetched and prefetched[1] is not None:
+            a['reads'] = prefetched[1]
+        else:
+            a['reads'] = load_reads(reads_sidecar if reads_sidecar else r2c, align.query_name)
+    return a
+
+def contig_results(a, gf):
+    """Finds the cleavage sites of a contig prepared by prepare_contig, with the filters gf
+
+    Returns the contig-centric result lines and the transcript ends
+    reached by the contig (contig_sites)
+    """
+    align = a['align']
+    lines_result = ''
+    contig_sites = []
     result_link = link_pairs = None
-    #for k in a:
-    #    logger.debug(k)
-    #    logger.debug(a[k])
-    results = find_polyA_cleavage(a,global_filters,feature_dict)
+    if a['reads'] is None:
+        results = []
+    else:
+        #for k in a:
+        #    logger.debug(k)
+        #    logger.debug(a[k])
+        results = find_polyA_cleavage(a,gf,feature_dict)
     if (a['report_closest']):
         if (a['strand'] == '+'):
             cs = align.reference_end
@@ -1955,118 +1685,560 @@ for align in aligns:
             lines_result += output_result(result, output_fields, feature_dict, link_pairs=link_pairs)
             #file_lines_result.write(output_result(result, output_fields, feature_dict, link_pairs=link_pairs))
             # check if chrom is in all_results
+    return lines_result, contig_sites
 
-# close output streams
-potential_bridges.close()
-FNULL = open(os.devnull, 'w')
-#bstart = [time.time(),time.strftime("%c")]
-print "Aligning bridge reads against genome..."
-#if not os.path.isfile('./.blat_alignment'):
-potential_bridges = os.path.join(os.path.dirname(args.out),'.potential_bridges')
-blat_alignment = os.path.join(os.path.dirname(args.out),'.bridge_to_genome')
-#if not args.resume and not os.path.isfile(blat_alignment):
-task = subprocess.Popen(['blat', args.ref_genome, potential_bridges, blat_alignment], stdout=FNULL)
-task.communicate()
-print "Blat alignment complete"
-print "Aligning bridge reads against transcripts..."
-blat_alignment2 = os.path.join(os.path.dirname(args.out),'.bridge_to_transcripts')
-task = subprocess.Popen(['blat', args.out+'.transcript_seqs', potential_bridges, blat_alignment2], stdout=FNULL)
-task.communicate()
-print "Blat alignment complete"
-#print 'blat_alignment: {}'.format(blat_alignment)
-#bend = [time.time(), time.strftime("%c")]
-print 'getting genome blat results...'
-blat_genome_results = get_blat_aln(blat_alignment)
-print 'Done!'
-print 'getting transcript blat results...'
-blat_transcript_results = get_blat_aln(blat_alignment2)
-print 'Done!'
-print 'Removing temp files...'
-os.remove(blat_alignment)
-os.remove(blat_alignment2)
-os.remove(args.out+'.transcript_seqs')
-#for read in blat_genome_results:
-#    print read
-#    print blat_genome_results[read]
-#print 'blat_genome_results: {}'.format(blat_genome_results)
-#print 'lines_result original: {}'.format(repr(lines_result))
-lines_result = lines_result.splitlines()
-keep = []
-#print 'lines_result before: {}'.format(lines_result)
-for result in lines_result:
-    result = result.split('\t')
-    target = result[5]
-    transcript = result[1]
-    cleavage_site = int(result[6])
-    bridge_reads = result[14].split(',')
-    temp = bridge_reads[:]
-    has_tail = (result[10] != '0')
-    if (bridge_reads == ['-']): 
-        if (has_tail):
-            keep.append(('\t').join(result))
-            continue
+def prescreen_contig(a):
+    """Decides up front whether a contig can produce tail or bridge read evidence
+
+    A contig is eliminated when
+    - neither of its ends nor any read aligned to it is clipped, so
+      find_tail_contig and find_bridge_reads have nothing to look at
+    - no end of an overlapping transcript is within --max_dist of it, so
+      any cleavage site it reports would be too far from an annotated end
+    """
+    align = a['align']
+    prescreen_counts['screened'] += 1
+    if int(a['qstart']) <= 1 and int(a['qend']) >= int(align.infer_query_length(True)) and not clip_counts.get(align.query_name):
+        prescreen_counts['unclipped'] += 1
+        return False
+    if not near_transcript_end(a['target'], a['close']['rows'], align):
+        prescreen_counts['far_from_ends'] += 1
+        return False
+    return True
+
+def overlapping_rows(target, align):
+    """Rows of the transcripts overlapping a contig alignment in the transcript table of target
+
+    With a strand specific library, only those on the strand of the contig
+    """
+    rows = transcript_index.overlaps(target, align.reference_start, align.reference_end)
+    if (args.strand_specific):
+        table = transcript_index.tables[target]
+        rows = rows[table['strand'][rows] == STRAND_CODES['-' if align.is_reverse else '+']]
+    return rows
+
+def near_transcript_end(target, rows, align):
+    """Whether the end of a transcript in rows is within --max_dist of a contig alignment"""
+    if not len(rows):
+        return False
+    table = transcript_index.tables[target]
+    ends = np.concatenate((table['tstart'][rows], table['tend'][rows]))
+    # cleavage sites lie within the contig alignment, or just past its end
+    dist = np.maximum(align.reference_start - ends, ends - (align.reference_end + 1))
+    return np.min(dist) <= args.max_dist
+
+def contig_key(align):
+    """Identifies a contig alignment in the journal"""
+    return (align.query_name, align.tid, align.reference_start, align.flag)
+
+def open_prefetch_handles():
+    """Opens the files read by the prefetching thread"""
+    if args.sidecar:
+        reads = ReadsSidecar(args.sidecar)
+    elif profiler:
+        reads = profiler.bam('prefetch r2c', pysam.AlignmentFile(args.r2c, "rb"))
+    else:
+        reads = pysam.AlignmentFile(args.r2c, "rb")
+    if profiler:
+        return profiler.fasta('prefetch contigs', pysam.FastaFile(args.contigs)), reads
+    return pysam.FastaFile(args.contigs), reads
+
+def prefetch_contig(handles, align):
+    """Loads the sequence and reads of a contig in the prefetching thread
+
+    Returns None for alignments analyse_contig skips before looking at reads,
+    and no reads for the contigs the pre-screen eliminates
+    """
+    if (align.reference_start == None) or (align.reference_end == None):
+        return None
+    if aligns.getrname(align.tid) not in transcript_index:
+        return None
+    contig_seq = handles[0].fetch(align.query_name)
+    if not reads_needed(align, len(contig_seq)):
+        return contig_seq, None
+    return contig_seq, load_reads(handles[1], align.query_name)
+
+def reads_needed(align, contig_length=None):
+    """Whether analyse_contig can look at the reads of a contig alignment
+
+    False for alignments it skips before looking at reads (with the same
+    filters as prepare_contig), and for the contigs the pre-screen
+    eliminates: unclipped contigs without clipped reads and those with no
+    transcript end within --max_dist. contig_length is looked up in the
+    contigs file if not given.
+    """
+    if (align.reference_start == None) or (align.reference_end == None):
+        return False
+    if contig_length is None:
+        contig_length = contigs.get_reference_length(align.query_name)
+    if align.query_alignment_length and contig_length:
+        if (float(align.query_alignment_length)/contig_length) < 0.6:
+            return False
+    target = aligns.getrname(align.tid)
+    if target not in transcript_index:
+        return False
+    rows = overlapping_rows(target, align)
+    if not len(rows):
+        return False
+    if args.prescreen:
+        if not clip_counts.get(align.query_name):
+            cigar = align.cigartuples
+            if cigar[0][0] in (0, 7, 8) and cigar[-1][0] in (0, 7, 8):
+                return False
+        if not near_transcript_end(target, rows, align):
+            return False
+    return True
+
+def load_reads(source, contig):
+    """Summary of the reads aligned to a contig
+
+    Fetched from the r2c BAM file or sidecar given as source, or taken from
+    read_summaries
+    """
+    if read_summaries is None:
+        if args.sidecar:
+            return source.get(contig)
+        return ContigReads(source.fetch(contig))
+    uses = read_summaries[contig]
+    uses[0] -= 1
+    # the last alignment of the contig frees its summary
+    if not uses[0]:
+        del read_summaries[contig]
+    return uses[1]
+
+def release_reads(align, prefetched=None):
+    """Frees the read summary counted for a contig alignment prepare_contig skips
+
+    With --stream_r2c, summaries are counted for the alignments
+    reads_needed passes and freed once all of them have loaded it.
+    Prefetched alignments were loaded by the prefetching thread.
+    """
+    if read_summaries is not None and not prefetched and reads_needed(align):
+        load_reads(None, align.query_name)
+
+def stream_read_summaries(align_iter):
+    """Summarises the reads of the contigs to analyse in one sequential pass over r2c
+
+    Returns {contig: [number of alignments, read summary]}
+    """
+    uses = {}
+    for align in align_iter:
+        if contig_key(align) not in journaled and reads_needed(align):
+            uses[align.query_name] = uses.get(align.query_name, 0) + 1
+    bam = pysam.AlignmentFile(args.r2c, 'rb')
+    if profiler:
+        bam = profiler.bam('r2c stream', bam)
+    summaries = summarise_contigs(bam, uses)
+    bam.close()
+    return dict((x, [uses[x], summaries[x]]) for x in uses)
+
+def analyse_contigs(align_iter):
+    """Runs analyse_contig over the given alignments, skipping those already journaled
+
+    Yields one record per contig: [key, result lines, contig_sites,
+    potential bridge reads, extended reads, cleavage sites added to transcripts],
+    or with --sweep [key, records of sweep_contig]
+    """
+    global start, potential_bridges, extended
+    files = potential_bridges, extended
+    align_iter = (x for x in align_iter if contig_key(x) not in journaled)
+    if args.prefetch > 0:
+        align_iter = Prefetcher(align_iter, prefetch_contig, open_handles=open_prefetch_handles, size=args.prefetch)
+    else:
+        align_iter = ((x, None) for x in align_iter)
+    for align, prefetched in align_iter:
+        key = contig_key(align)
+        if profiler:
+            contig_start = time.time()
+        else:
+            try:
+                print '{}\t{}'.format(align.qname,time.time()-start)
+            except NameError:
+                start = time.time()
+            start = time.time()
+        if sweep:
+            record = [key, sweep_contig(align, prefetched)]
+        else:
+            potential_bridges, extended = cStringIO.StringIO(), cStringIO.StringIO()
+            del cleavage_site_log[:]
+            lines, sites = analyse_contig(align, prefetched)
+            record = [key, lines, sites, potential_bridges.getvalue(), extended.getvalue(), list(cleavage_site_log)]
+        if profiler:
+            profiler.add_contig(time.time() - contig_start, align.query_name)
+        potential_bridges, extended = files
+        yield record
+
+def sweep_contig(align, prefetched=None):
+    """Finds the cleavage sites of one contig with the filters of each --sweep combination
+
+    The contig is prepared once for all combinations. Returns a record per
+    combination: [result lines, contig_sites, potential bridge reads,
+    extended reads, cleavage sites added to transcripts]
+    """
+    global potential_bridges, extended
+    a = prepare_contig(align, prefetched)
+    if a is not None:
+        report_closest = a['report_closest']
+    records = []
+    for gf in sweep:
+        potential_bridges, extended = cStringIO.StringIO(), cStringIO.StringIO()
+        del cleavage_site_log[:]
+        if a is None:
+            lines, sites = '', []
+        else:
+            # annotate_cleavage_site clears it for the sites each combination finds
+            a['report_closest'] = report_closest
+            lines, sites = contig_results(a, gf)
+        records.append([lines, sites, potential_bridges.getvalue(), extended.getvalue(), list(cleavage_site_log)])
+    return records
+
+def add_record(record):
+    """Adds the results of one contig to the run"""
+    global lines_result
+    if sweep:
+        for sweep_result, sweep_record in zip(sweep_results, record[1]):
+            sweep_result[0] += sweep_record[0]
+            sweep_result[1].extend(sweep_record[1])
+            # reads picked by several combinations are aligned once
+            write_new_reads(potential_bridges, sweep_record[2], sweep_reads[0])
+            write_new_reads(extended, sweep_record[3], sweep_reads[1])
+        return
+    lines_result += record[1]
+    contig_sites.extend(record[2])
+    potential_bridges.write(record[3])
+    extended.write(record[4])
+
+def write_new_reads(out, fasta, seen):
+    """Writes the reads of a FASTA string that are not in seen to out, adding them to seen"""
+    fasta = fasta.splitlines()
+    for i in xrange(0, len(fasta), 2):
+        read = (fasta[i], fasta[i + 1])
+        if read not in seen:
+            seen.add(read)
+            out.write('{}\n{}\n'.format(*read))
+
+def bridge_transcripts_of(lines_result):
+    """(chromosome, transcript) of the result lines with bridge reads"""
+    transcripts = set()
+    for result in lines_result:
+        result = result.split('\t')
+        if result[14] != '-':
+            transcripts.add((result[5], result[1]))
+    return transcripts
+
+def parse_regions(specs, bam):
+    """Parses --region values into merged [chrom, start, end] regions
+
+    Each value is a reference name, chr:start-end (1-based, inclusive) or
+    a BED file. Regions are returned 0-based, half-open and in the order
+    of the BAM.
+    """
+    lengths = dict(zip(bam.references, bam.lengths))
+    regions = {}
+    def add_region(chrom, start, end, spec):
+        if chrom not in lengths:
+            sys.exit("Region {} is not on a reference of the contig-to-genome alignment file. Exiting.".format(spec))
+        start = max(0, start)
+        end = min(lengths[chrom], end)
+        if start >= end:
+            sys.exit("Region {} is empty. Exiting.".format(spec))
+        if chrom not in regions:
+            regions[chrom] = []
+        regions[chrom].append([chrom, start, end])
+    for spec in specs:
+        if os.path.isfile(spec):
+            with open(spec, 'r') as f:
+                for line in f:
+                    if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                        continue
+                    fields = line.split()
+                    add_region(fields[0], int(fields[1]), int(fields[2]), line.strip())
+        elif spec in lengths:
+            add_region(spec, 0, lengths[spec], spec)
         else:
+            m = re.match(r'^(.+):([\d,]+)-([\d,]+)$', spec)
+            if not m:
+                sys.exit("Unrecognized region {}, must be chr, chr:start-end or a BED file. Exiting.".format(spec))
+            add_region(m.group(1), int(m.group(2).replace(',', '')) - 1, int(m.group(3).replace(',', '')), spec)
+    merged = []
+    for chrom in bam.references:
+        if chrom not in regions:
             continue
-    #[int(qsize),int(qstart),int(qend),target,int(block_count),score,int(tstart),int(tend)]
-    for read in temp:
-        remove_read = False
-        maxlocal = maxnonlocal = None
-        has_target_aln = False
-        if read not in blat_genome_results:
+        for region in sorted(regions[chrom]):
+            if merged and merged[-1][0] == chrom and region[1] <= merged[-1][2]:
+                merged[-1][2] = max(merged[-1][2], region[2])
+            else:
+                merged.append(region)
+    return merged
+
+def fetch_regions(bam, regions):
+    """Yields the alignments overlapping the sorted, non-overlapping regions
+
+    An alignment overlapping several regions is only yielded for the first
+    """
+    prev = None
+    for chrom, start, end in regions:
+        for align in bam.fetch(chrom, start, end):
+            # already yielded for the previous region
+            if prev and prev[0] == chrom and align.reference_start < prev[2]:
+                continue
+            yield align
+        prev = [chrom, start, end]
+
+def select_alignments(bam, regions=None):
+    """Yields the contig alignments to analyse
+
+    Restricts the alignments to the given regions using the BAM index,
+    then to the contigs given with -c and the first --limit contigs
+    """
+    if regions:
+        align_iter = fetch_regions(bam, regions)
+    else:
+        align_iter = bam.fetch(until_eof=True)
+    # If contigs are specified only look at those
+    if args.c:
+        align_iter = (x for x in align_iter if x.query_name in args.c)
+    if args.limit:
+        align_iter = itertools.islice(align_iter, args.limit)
+    return align_iter
+
+def make_shards(c2g, num_shards):
+    """Splits the annotated genome into regions that can be analysed independently
+
+    Regions are only cut where neither a contig alignment nor an annotated
+    transcript spans the cut. Every transcript a contig can be assigned to
+    is therefore seen by a single worker, so the per-transcript cleavage
+    site bookkeeping, and hence the results, match a serial run.
+    Regions hold roughly equal numbers of alignments and are returned as
+    [chrom, start, end] in the order of the BAM.
+    """
+    bam = pysam.AlignmentFile(c2g, 'rb')
+    spans = {}
+    for align in select_alignments(bam, regions):
+        if align.is_unmapped or (align.reference_start == None) or (align.reference_end == None):
             continue
-        if read == '-':
+        chrom = bam.getrname(align.tid)
+        if chrom not in transcript_index:
             continue
-        #print 'Looking at read {}'.format(read)
-        for x in blat_genome_results[read]:
-            #print '  Looking at alignment {}'.format(x)
-            # If the alignment does not match the target and does
-            # not align fully to the genome, then we don't care
-            if (x[3] != target) and ((x[1] != 0) or (x[0] != x[2]) or (x[4] != 1)):
-                continue
-            # If none of the alignments match the cs target
-            # then this read should be removed and noted
-            if (x[3] == target) and (x[7] == cleavage_site) and (x[5] > maxlocal):
-                has_target_aln = True
-                maxlocal = x[5]
-            if (x[3] != target) and (x[5] > maxnonlocal):
-                maxnonlocal = x[5]
-        if ((maxnonlocal and maxlocal) and (maxnonlocal > maxlocal)) or not (has_target_aln):
-            remove_read = True
-        # Check transcript alignments
-        if read not in blat_transcript_results:
+        if chrom not in spans:
+            spans[chrom] = []
+        spans[chrom].append((align.reference_start, align.reference_end, 1))
+    total = sum([len(x) for x in spans.values()])
+    size = max(1, total / num_shards)
+    shards = []
+    for chrom in bam.references:
+        if chrom not in spans:
             continue
-        elif any([((x[3] == transcript) and (x[1] == 0) and (x[0] == x[2]) and (x[4] == 1)) for x in blat_transcript_results[read]]):
-            remove_read = True
-        if remove_read:
-            temp.remove(read)
-            result[13] = '-'
-            result[15] = str(int(result[15]) - 1)
-    if not temp and not has_tail:
-        continue
-    elif temp and temp != ['-']:
-        result[14] = (',').join(temp)
-        result[12] = str(len(temp))
+        table = transcript_index.tables[chrom]
+        intervals = sorted(spans[chrom] + zip(table['tstart'], table['tend'], [0]*len(table['tstart'])))
+        # merge overlapping intervals into clusters of [start, end, alignments]
+        clusters = []
+        for start, end, count in intervals:
+            if clusters and start < clusters[-1][1]:
+                clusters[-1][1] = max(clusters[-1][1], end)
+                clusters[-1][2] += count
+            else:
+                clusters.append([start, end, count])
+        shard = None
+        for start, end, count in clusters:
+            if shard is None:
+                shard = [chrom, start, end, 0]
+            shard[2] = end
+            shard[3] += count
+            if shard[3] >= size:
+                shards.append(shard[:3])
+                shard = None
+        if shard is not None and shard[3]:
+            shards.append(shard[:3])
+    bam.close()
+    return shards
+
+def profile_handles():
+    """Counts the fetches through the pysam handles of this process"""
+    global aligns, contigs, r2c
+    aligns = profiler.bam('c2g', aligns)
+    contigs = profiler.fasta('contigs', contigs)
+    r2c = profiler.bam('r2c', r2c)
+    refseq.fasta = profiler.fasta('refseq', refseq.fasta)
+
+def profile_stages():
+    """Times the analysis and reporting functions as profiler stages"""
+    for name in ('analyse_contig', 'sweep_contig', 'prepare_contig', 'contig_results', 'prescreen_contig', 'find_polyA_cleavage', 'find_tail_contig', 'find_bridge_reads',
+                 'get_num_tail_reads', 'annotate_cleavage_site', 'findBindingSites'):
+        globals()[name] = profiler.wrap(name, globals()[name])
+    transcript_index.overlaps = profiler.wrap('transcript overlaps', transcript_index.overlaps)
+    run_blat = results.run_blat
+    def timed_blat(database, queries, out_file):
+        # chunks (--blat_threads) are timed together with their search
+        with profiler.stage('blat ' + re.sub(r'\.\d+$', '', os.path.basename(out_file).lstrip('.'))):
+            run_blat(database, queries, out_file)
+    results.run_blat = timed_blat
+    for name in ('summarise_genome_alignments', 'summarise_transcript_alignments'):
+        setattr(results, name, profiler.wrap('psl parse', getattr(results, name)))
+    results.group_and_filter = profiler.wrap('group_and_filter', results.group_and_filter)
+
+def init_worker():
+    """Opens separate file handles in each worker process"""
+    global refseq, aligns, contigs, r2c, reads_sidecar
+    refseq = ReferenceCache(pysam.FastaFile(args.ref_genome))
+    transcript_seqs.refseq = refseq
+    aligns = pysam.AlignmentFile(args.c2g, "rb")
+    contigs = pysam.FastaFile(args.contigs)
+    r2c = pysam.AlignmentFile(args.r2c, "rb")
+    if args.sidecar:
+        reads_sidecar = ReadsSidecar(args.sidecar)
+    if profiler:
+        profile_handles()
+
+def analyse_shard(shard):
+    """Analyses the contigs starting in one region, in a worker process
+
+    Returns the contig records and the reference cache hit/miss,
+    pre-screen and profiler counts
+    """
+    chrom, start, end = shard
+    refseq.reset_counts()
+    prescreen_counts.update(dict.fromkeys(RULES, 0))
+    if profiler:
+        profiler.reset()
+    if regions:
+        shard_regions = [[c, max(s, start), min(e, end)] for c, s, e in regions if c == chrom and s < end and e > start]
+    else:
+        shard_regions = [[chrom, start, end]]
+    align_iter = (x for x in select_alignments(aligns, shard_regions) if start <= x.reference_start < end)
+    records = list(analyse_contigs(align_iter))
+    return records, {'ref': (refseq.hits, refseq.misses), 'prescreen': prescreen_counts,
+                     'profile': profiler.state() if profiler else None}
+
+lines_result = lines_bridge = lines_link = ''
+contig_sites = []
+# With --sweep, [result lines, contig_sites] of each combination (sweep_results),
+# and the potential bridge and extended reads written so far (sweep_reads)
+sweep_results = [['', []] for gf in sweep] if sweep else None
+sweep_reads = (set(), set())
+link_pairs = None
+regions = None
+if args.region:
+    if not aligns.has_index():
+        sys.exit("--region needs a coordinate sorted and indexed contig-to-genome BAM file. Exiting.")
+    regions = parse_regions(args.region, aligns)
+if args.processes > 1 and args.limit:
+    # the first --limit contigs can't be split between workers
+    logger.info("--limit is given, analysing contigs in a single process")
+    args.processes = 1
+
+# Journal of analysed contigs (journal), the run parameters must match to resume
+journal = Journal(args.out+'.journal', dict((k, v) for k, v in vars(args).items()
+                                            if k not in ('resume', 'processes', 'prefetch', 'profile', 'profile_top', 'emit_partial',
+                                                         'stream_r2c', 'sidecar', 'blat_threads')))
+try:
+    records, complete = journal.open(resume=args.resume)
+except JournalError as e:
+    sys.exit("{}, can't resume. Exiting.".format(e))
+journaled = set()
+for record in records:
+    if sweep:
+        for gf, sweep_record in zip(sweep, record[1]):
+            for chrom, tid, cleavage_site in sweep_record[4]:
+                gf['cleavage_sites'].setdefault((chrom, tid), []).append(cleavage_site)
     else:
-        result[14] = '-'
-        result[12] = '0'
-    keep.append(('\t').join(result))
-#print 'keep: {}'.format(repr(keep))
-lines_result = ('\n').join(keep)
-#print 'lr before adding contig sites: {}'.format(lines_result)
-#if len(keep) == 1:
-#    lines_result += '\n'
-#print 'lines_result after adding keep: {}'.format(repr(lines_result))
-if contig_sites:
-    contig_sites = filter_contig_sites(contig_sites,feature_dict)
-if contig_sites and lines_result:
-    lines_result += '\n'
-for result in contig_sites:
-#    print result
-    #print output_result(result['a'], result, output_fields, feature_dict, link_pairs=link_pairs)
-    #raw_input('^'*20)
-    temp = output_result(result, output_fields, feature_dict, link_pairs=link_pairs)
-    lines_result += temp
-    #file_lines_result.write(temp)
-#print 'final lines_result: {}'.format(repr(lines_result))
-#file_lines_result.close()
-group_and_filter(lines_result, args.out+'.KLEAT', filters=global_filters, make_track=args.track, rgb=args.rgb)
+        for chrom, tid, cleavage_site in record[5]:
+            feature_dict[chrom][tid].add_cleavage_site(cleavage_site)
+    add_record(record)
+    journaled.add(record[0])
+if records:
+    logger.info("Resuming after %d journaled contigs", len(records))
+del records
+
+if profiler:
+    profile_handles()
+    profile_stages()
+loop_start = time.time()
+if args.stream_r2c and not complete:
+    # before the workers are forked, so they share the summaries
+    c2g = pysam.AlignmentFile(args.c2g, 'rb')
+    read_summaries = stream_read_summaries(select_alignments(c2g, regions))
+    c2g.close()
+    logger.info("Summarised the reads of %d contigs", len(read_summaries))
+    if profiler:
+        profiler.add_stage('r2c stream', time.time() - loop_start)
+if complete:
+    logger.info("All contigs were analysed before, going straight to the bridge read alignment")
+elif args.processes > 1:
+    if not aligns.has_index():
+        sys.exit("--processes needs a coordinate sorted and indexed contig-to-genome BAM file. Exiting.")
+    shards = make_shards(args.c2g, args.processes * 4)
+    pool = multiprocessing.Pool(args.processes, initializer=init_worker)
+    # imap returns shards in order, so the merged results are deterministic
+    for shard_records, counts in pool.imap(analyse_shard, shards):
+        for record in shard_records:
+            add_record(record)
+            journal.append(record)
+        refseq.hits += counts['ref'][0]
+        refseq.misses += counts['ref'][1]
+        for rule in RULES:
+            prescreen_counts[rule] += counts['prescreen'][rule]
+        if profiler:
+            profiler.merge(counts['profile'])
+    pool.close()
+    pool.join()
+else:
+    for record in analyse_contigs(select_alignments(aligns, regions)):
+        add_record(record)
+        journal.append(record)
+journal.finish()
+journal.close()
+if profiler:
+    profiler.add_stage('contig loop', time.time() - loop_start)
+
+# close output streams
+potential_bridges.close()
+potential_bridges = os.path.join(os.path.dirname(args.out),'.potential_bridges')
+contig_sites = [(x['cleavage_site'], output_result(x, output_fields, feature_dict, link_pairs=link_pairs).rstrip('\n')) for x in contig_sites]
+lines_result = lines_result.splitlines()
+# Only transcripts reported with bridge reads are needed for the transcript filter
+bridge_transcripts = bridge_transcripts_of(lines_result)
+if sweep:
+    queries = {}
+    for sweep_result in sweep_results:
+        sweep_result[0] = sweep_result[0].splitlines()
+        sweep_result[1] = [(x['cleavage_site'], output_result(x, output_fields, feature_dict, link_pairs=link_pairs).rstrip('\n')) for x in sweep_result[1]]
+        bridge_transcripts.update(bridge_transcripts_of(sweep_result[0]))
+        bridge_read_queries(sweep_result[0], queries)
+    # the bridge reads of all combinations are aligned at once
+    transcript_seqs.write_fasta(args.out+'.transcript_seqs', sorted(bridge_transcripts))
+    blat_results = align_bridge_reads(potential_bridges, args.out+'.transcript_seqs', args.ref_genome, basedir, queries,
+                                      threads=args.blat_threads)
+    with open(args.out+'.sweep.tsv', 'w') as out:
+        out.write('\t'.join(['sweep'] + [x[0] for x in SWEEP_PARAMS]) + '\n')
+        for i, (gf, sweep_result) in enumerate(zip(sweep, sweep_results)):
+            sweep_out = '{}.sweep{}'.format(args.out, i + 1)
+            write_results(sweep_result[0], sweep_result[1], blat_results, sweep_out,
+                          filters=gf, make_track=args.track, rgb=args.rgb)
+            values = [gf[x[1]] for x in SWEEP_PARAMS]
+            out.write('\t'.join([str(i + 1)] + [' '.join(map(str, x)) if isinstance(x, list) else str(x) for x in values]) + '\n')
+    print "Results of {} parameter combinations written to {}.sweep<N>.KLEAT, listed in {}".format(len(sweep), args.out, args.out+'.sweep.tsv')
+elif args.emit_partial:
+    # Parameters partial results must share to be merged
+    params = dict((k, getattr(args, k)) for k in ('c2g', 'contigs', 'ref_genome', 'annot', 'r2c', 'trim_reads',
+                                                  'strand_specific', 'min_at', 'max_diff', 'max_diff_link',
+                                                  'max_poor_bases_in_bridge_read', 'min_bridge_size', 'max_dist',
+                                                  'link', 'overlap_est', 'tail_coverage'))
+    # Partials are merged in the order of their first region
+    order = [aligns.gettid(regions[0][0]), regions[0][1]] if regions else []
+    transcripts = [(tid, transcript_seqs.fetch(chrom, tid)) for chrom, tid in sorted(bridge_transcripts)]
+    write_partial(args.out+'.partial', params, order, lines_result, contig_sites, potential_bridges, transcripts)
+    print "Partial results written to {}".format(args.out+'.partial')
+else:
+    transcript_seqs.write_fasta(args.out+'.transcript_seqs', sorted(bridge_transcripts))
+    report_results(lines_result, contig_sites, potential_bridges, args.out+'.transcript_seqs', args.ref_genome, args.out,
+                   filters=global_filters, make_track=args.track, rgb=args.rgb, blat_threads=args.blat_threads)
+# the results are written, there is nothing left to resume
+journal.remove()
+logger.info("Reference sequence cache: %d hits, %d misses", refseq.hits, refseq.misses)
+if args.prescreen:
+    logger.info("Pre-screen: %d contigs screened, %d eliminated with unclipped ends and reads, %d eliminated with no transcript end within %d",
+                prescreen_counts['screened'], prescreen_counts['unclipped'], prescreen_counts['far_from_ends'], args.max_dist)
+if profiler:
+    profiler.write(args.out+'.profile.json')
+    print "Profile written to {}".format(args.out+'.profile.json')
@@ -0,0 +1,21 @@
+__version__ = '2.1'
+
+import argparse
+import sys
+import time
+# In house modules below
+from sidecar import write_sidecar, default_sidecar_path, SidecarError
+
+parser = argparse.ArgumentParser(description='Extracts the reads KLEAT looks at (reads clipped at one end, and the spans of unclipped reads) from a reads-to-contigs alignment into a sidecar file, which KLEAT runs on the same library can read with --sidecar instead of the alignment.')
+parser.add_argument('r2c', metavar='<reads-to-contigs>', help='The reads-to-contigs alignment file in bam format, sorted by contig.')
+parser.add_argument('-o', '--out', help='The sidecar file to write. Default is <reads-to-contigs>.kleat_reads')
+parser.add_argument('-l', '--level', type=int, default=6, help='zlib compression level of the sidecar. Default is 6.')
+args = parser.parse_args()
+
+out = args.out or default_sidecar_path(args.r2c)
+start = time.time()
+try:
+    contigs = write_sidecar(out, args.r2c, level=args.level)
+except SidecarError as e:
+    sys.exit("{}. Exiting.".format(e))
+print "Reads of {} contigs written to {} in {:.1f}s".format(contigs, out, time.time() - start)
@@ -0,0 +1,39 @@
+__version__ = '2.1'
+
+import argparse
+import os
+import sys
+# In house modules below
+from results import Partial, merge_partials, report_results, output_fields
+
+parser = argparse.ArgumentParser(description='Merges the partial results of KLEAT runs made with --emit-partial, e.g. over different regions of the genome on different nodes, into the .KLEAT, .stats and track files of a single run over the whole library.')
+parser.add_argument('partials', metavar='<partial>', nargs='+', help='Partial results files written by KLEAT --emit-partial.')
+parser.add_argument('out', metavar='<output-file>', help='The file to output results.')
+parser.add_argument('-r', '--ref_genome', help='The reference genome to align bridge reads against. Default is the one the partial results were made with.')
+parser.add_argument('-k', '--track', metavar=('[name]','[description]'), help='Name and description of BED graph track to output.', nargs=2)
+parser.add_argument('--rgb', help='RGB value of BED graph. Default is 0,0,255', default='0,0,255')
+parser.add_argument('--blat_threads', type=int, default=1, help='Number of blat processes run at once to align the potential bridge reads, as for KLEAT. Default is 1.')
+args = parser.parse_args()
+
+try:
+    partials = [Partial(x) for x in args.partials]
+except ValueError as e:
+    sys.exit("{}. Exiting.".format(e))
+for partial in partials[1:]:
+    if partial.params != partials[0].params:
+        sys.exit("{} and {} were made with different parameters. Exiting.".format(partials[0].path, partial.path))
+params = partials[0].params
+if params.get('tail_coverage') is not None:
+    output_fields.append('tail_coverage')
+# Merge in genome order, partials of the same position keep the given order
+partials = sorted(partials, key=lambda x: x.order)
+
+basedir = os.path.dirname(args.out)
+if basedir and not os.path.exists(basedir):
+    os.makedirs(basedir)
+potential_bridges = os.path.join(basedir,'.potential_bridges')
+transcript_seqs = args.out+'.transcript_seqs'
+lines_result, contig_sites = merge_partials(partials, potential_bridges, transcript_seqs)
+report_results(lines_result, contig_sites, potential_bridges, transcript_seqs, args.ref_genome or params['ref_genome'], args.out,
+               filters={'min_bridge_size': params['min_bridge_size']}, make_track=args.track, rgb=args.rgb,
+               blat_threads=args.blat_threads)
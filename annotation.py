@@ -0,0 +1,294 @@
+"""Annotation model used by KLEAT
+
+Builds the per-chromosome transcript dictionary (feature_dict) from a GTF
+file and keeps a versioned binary copy of it on disk so that later runs
+against the same annotation can skip re-parsing the GTF.
+"""
+
+import zlib
+import logging
+from collections import OrderedDict
+# External modules below
+import numpy as np
+# In house modules below
+from customclasses import Transcript
+from signedfile import read_signed_pickle, write_signed_pickle
+
+logger = logging.getLogger('polyA_logger')
+
+# Bump whenever the layout of feature_dict changes so stale caches are rebuilt
+CACHE_VERSION = 4
+CACHE_SUFFIX = '.kleat_cache'
+
+# Integer codes of transcript strands in TranscriptIndex tables
+STRAND_CODES = {'+': 1, '-': -1}
+
+def read_gz_lines(f, blocksize=1 << 22):
+    """Yields the lines of a gzip/bgzip file, decompressing large blocks at a time
+
+    This is much faster than iterating over gzip.GzipFile. Concatenated
+    gzip members, as written by bgzip, are followed one after the other.
+    """
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    rest = ''
+    block = f.read(blocksize)
+    while block:
+        data = decomp.decompress(block)
+        while decomp.unused_data:
+            block = decomp.unused_data
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decomp.decompress(block)
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+        block = f.read(blocksize)
+    if rest:
+        yield rest
+
+def read_gtf_lines(annot):
+    """Yields the lines (without newline) of a plain or gzip compressed GTF file"""
+    with open(annot, 'rb') as f:
+        if f.read(2) == '\x1f\x8b':
+            f.seek(0)
+            for line in read_gz_lines(f):
+                yield line
+        else:
+            f.seek(0)
+            for line in f:
+                yield line.rstrip('\n')
+
+def gtf_attribute(attributes, key):
+    """Returns the value of key in a GTF attribute column, or None"""
+    i = attributes.find(key)
+    while i != -1:
+        j = i + len(key)
+        # the key has to be a whole word followed by its value
+        if (i == 0 or attributes[i-1] in ' ;') and attributes[j:j+1] == ' ':
+            end = attributes.find(';', j)
+            if end == -1:
+                end = len(attributes)
+            return attributes[j:end].strip().strip('"')
+        i = attributes.find(key, j)
+    return None
+
+def iter_gtf(annot):
+    """Streams the fields KLEAT uses out of a GTF file
+
+    Yields (chrom, feature, start, end, strand, transcript_id, gene_id)
+    with start 0-based and end 1-based, as pysam's asGTF reports them.
+    Only the attributes that are needed are extracted from the last column.
+    """
+    for line in read_gtf_lines(annot):
+        if not line or line[0] == '#':
+            continue
+        cols = line.split('\t', 8)
+        if len(cols) < 9:
+            continue
+        attributes = cols[8]
+        yield (cols[0], cols[2], int(cols[3]) - 1, int(cols[4]), cols[6],
+               gtf_attribute(attributes, 'transcript_id'), gtf_attribute(attributes, 'gene_id'))
+
+def build_feature_dict(annot):
+    """Parses a GTF file into {chrom: {transcript_id: Transcript}}"""
+    feature_dict = {}
+    for chrom, feature, start, end, strand, tid, gene_id in iter_gtf(annot):
+        # gene level rows are not part of any transcript
+        if tid is None:
+            continue
+        if chrom not in feature_dict:
+            feature_dict[chrom] = {}
+        if tid not in feature_dict[chrom]:
+            feature_dict[chrom][tid] = Transcript(tid, chrom, start, end, gene_id=gene_id)
+        current = feature_dict[chrom][tid]
+        if (not current.strand):
+            current.strand = strand
+        if (end >= current.tend):
+            current.tend = end
+        if (feature == 'exon'):
+            current.add_exon(start, end)
+        if (feature == 'CDS') and (not current.cstart):
+            current.cstart = start
+        elif (feature == 'CDS'):
+            current.cend = end
+
+    # Go through the feature_dict and try to determine 3utrs
+    for chrom in feature_dict:
+        for tid in feature_dict[chrom]:
+            current = feature_dict[chrom][tid]
+            current.utr3 = current.get_utr3()
+    return feature_dict
+
+def default_cache_path(annot):
+    return annot + CACHE_SUFFIX
+
+def load_feature_dict(annot, cache_path=None, use_cache=True):
+    """Returns feature_dict for annot, using (and refreshing) the on-disk cache
+
+    cache_path defaults to the GTF path plus '.kleat_cache'.
+    """
+    if not use_cache:
+        return build_feature_dict(annot)
+    if cache_path is None:
+        cache_path = default_cache_path(annot)
+    feature_dict = read_signed_pickle(cache_path, CACHE_VERSION, annot, 'Annotation cache')
+    if feature_dict is not None:
+        logger.debug('Loaded annotation model from cache %s', cache_path)
+        return feature_dict
+    feature_dict = build_feature_dict(annot)
+    if write_signed_pickle(cache_path, CACHE_VERSION, annot, feature_dict, 'Annotation cache'):
+        logger.debug('Wrote annotation cache %s', cache_path)
+    return feature_dict
+
+class TranscriptSeqs:
+    """Spliced transcript sequences, built from the reference on first use
+
+    At most maxsize sequences are kept, the least recently used one is
+    dropped when the limit is reached.
+    """
+
+    def __init__(self, feature_dict, refseq, maxsize=1024):
+        self.feature_dict = feature_dict
+        self.refseq = refseq
+        self.maxsize = maxsize
+        self.seqs = OrderedDict()
+
+    def fetch(self, chrom, tid):
+        key = (chrom, tid)
+        try:
+            seq = self.seqs.pop(key)
+        except KeyError:
+            exons = self.feature_dict[chrom][tid].exons
+            seq = ('').join([self.refseq.fetch(chrom,x[0],x[1]).upper() for x in exons])
+            if len(self.seqs) >= self.maxsize:
+                self.seqs.popitem(last=False)
+        self.seqs[key] = seq
+        return seq
+
+    def write_fasta(self, out_file, transcripts):
+        """Writes the sequences of the given (chrom, tid) pairs in FASTA format"""
+        with open(out_file, 'w') as out:
+            for chrom, tid in transcripts:
+                out.write('>{}\n{}\n'.format(tid, self.fetch(chrom, tid)))
+
+class TranscriptIndex:
+    """In-memory interval index of the transcripts in feature_dict
+
+    Transcript spans of each chromosome are kept sorted by start in an
+    implicit augmented binary tree (every node stores the largest end in
+    its subtree), so an overlap query costs O(log n + k) without touching
+    the GTF file.
+
+    The transcripts of each chromosome are also exposed, in the same row
+    order, as a table of NumPy columns (tables[chrom]):
+        tid, tstart, tend, strand (see STRAND_CODES), has_utr3,
+        utr3_start, utr3_end (-1 when there is no 3'UTR)
+    """
+
+    def __init__(self, feature_dict):
+        self.feature_dict = feature_dict
+        self.chroms = {}
+        self.tables = {}
+        for chrom in feature_dict:
+            spans = sorted((t.tstart, t.tend, tid) for tid, t in feature_dict[chrom].iteritems())
+            starts = [x[0] for x in spans]
+            ends = [x[1] for x in spans]
+            tids = [x[2] for x in spans]
+            maxends, max_level = self.augment(starts, ends)
+            self.chroms[chrom] = (starts, ends, tids, maxends, max_level)
+            self.tables[chrom] = self.make_table(feature_dict[chrom], tids)
+
+    @staticmethod
+    def make_table(transcripts, tids):
+        """Returns the columns of the given transcripts as NumPy arrays"""
+        utr3s = [transcripts[tid].utr3 or [-1, -1] for tid in tids]
+        table = {'tid': np.empty(len(tids), dtype=object),
+                 'tstart': np.array([transcripts[tid].tstart for tid in tids], dtype=np.int64),
+                 'tend': np.array([transcripts[tid].tend for tid in tids], dtype=np.int64),
+                 'strand': np.array([STRAND_CODES.get(transcripts[tid].strand, 0) for tid in tids], dtype=np.int8),
+                 'has_utr3': np.array([bool(transcripts[tid].utr3) for tid in tids], dtype=bool),
+                 'utr3_start': np.array([x[0] for x in utr3s], dtype=np.int64),
+                 'utr3_end': np.array([x[1] for x in utr3s], dtype=np.int64)}
+        table['tid'][:] = tids
+        return table
+
+    def __contains__(self, chrom):
+        return chrom in self.chroms
+
+    @staticmethod
+    def augment(starts, ends):
+        """Computes the max end of each implicit subtree, returns (maxends, root level)"""
+        n = len(ends)
+        if n == 0:
+            return [], -1
+        maxends = ends[:]
+        last_i = 0
+        last = ends[0]
+        for i in xrange(0, n, 2):
+            last_i = i
+            last = ends[i]
+        k = 1
+        while (1 << k) <= n:
+            x = 1 << (k - 1)
+            for i in xrange((x << 1) - 1, n, x << 2):
+                el = maxends[i - x]
+                er = maxends[i + x] if i + x < n else last
+                maxends[i] = max(ends[i], el, er)
+            last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+        return maxends, k - 1
+
+    def span_overlaps(self, chrom, start, end):
+        """Returns sorted indices of transcripts whose span overlaps [start, end)"""
+        if chrom not in self.chroms:
+            return []
+        starts, ends, tids, maxends, max_level = self.chroms[chrom]
+        n = len(starts)
+        hits = []
+        if n == 0:
+            return hits
+        stack = [((1 << max_level) - 1, max_level, 0)]
+        while stack:
+            x, k, w = stack.pop()
+            if k <= 3:
+                # small subtree, scan it linearly
+                i = x >> k << k
+                i1 = min(i + (1 << (k + 1)) - 1, n)
+                while i < i1 and starts[i] < end:
+                    if start < ends[i]:
+                        hits.append(i)
+                    i += 1
+            elif w == 0:
+                # first visit, descend into the left child if it can overlap
+                y = x - (1 << (k - 1))
+                stack.append((x, k, 1))
+                if y >= n or maxends[y] > start:
+                    stack.append((y, k - 1, 0))
+            elif x < n and starts[x] < end:
+                # second visit, check this node then the right child
+                if start < ends[x]:
+                    hits.append(x)
+                stack.append((x + (1 << (k - 1)), k - 1, 0))
+        hits.sort()
+        return hits
+
+    def overlaps(self, chrom, start, end):
+        """Returns table rows of transcripts with an exon overlapping [start, end)
+
+        Transcripts without exons are matched on their span.
+        """
+        rows = []
+        if chrom in self.chroms:
+            tids = self.chroms[chrom][2]
+            for i in self.span_overlaps(chrom, start, end):
+                if self.feature_dict[chrom][tids[i]].overlaps_exon(start, end):
+                    rows.append(i)
+        return np.array(rows, dtype=np.intp)
+
+    def fetch(self, chrom, start, end):
+        """Returns ids of transcripts with an exon overlapping [start, end)"""
+        if chrom not in self.tables:
+            return []
+        return list(self.tables[chrom]['tid'][self.overlaps(chrom, start, end)])
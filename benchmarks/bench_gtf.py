@@ -0,0 +1,80 @@
+"""Benchmark of building feature_dict from a GTF file
+
+Compares the streaming loader in annotation.py against reading the same
+file through pysam's asGTF proxies with asDict() per row, which is how
+KLEAT used to load annotations, and checks both give the same model.
+
+usage: python bench_gtf.py <annotations.gtf[.gz]> [repeats]
+"""
+
+import os
+import sys
+import time
+# External modules below
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# In house modules below
+from annotation import build_feature_dict
+from customclasses import Transcript
+
+def build_feature_dict_pysam(annot):
+    """feature_dict built through pysam proxy objects"""
+    feature_dict = {}
+    for c in pysam.tabix_iterator(open(annot), parser=pysam.asGTF()):
+        attrs = c.asDict()
+        if 'transcript_id' not in attrs:
+            continue
+        chrom, tid = c.contig, attrs['transcript_id']
+        if chrom not in feature_dict:
+            feature_dict[chrom] = {}
+        if tid not in feature_dict[chrom]:
+            feature_dict[chrom][tid] = Transcript(tid, chrom, c.start, c.end, gene_id=attrs.get('gene_id'))
+        current = feature_dict[chrom][tid]
+        if (not current.strand):
+            current.strand = c.strand
+        if (c.end >= current.tend):
+            current.tend = c.end
+        if (c.feature == 'exon'):
+            current.add_exon(c.start, c.end)
+        if (c.feature == 'CDS') and (not current.cstart):
+            current.cstart = c.start
+        elif (c.feature == 'CDS'):
+            current.cend = c.end
+    for chrom in feature_dict:
+        for tid in feature_dict[chrom]:
+            current = feature_dict[chrom][tid]
+            current.utr3 = current.get_utr3()
+    return feature_dict
+
+def model_state(feature_dict):
+    """Comparable contents of a feature_dict"""
+    return dict(((chrom, tid), t.__getstate__()) for chrom in feature_dict for tid, t in feature_dict[chrom].iteritems())
+
+def best_time(fn, annot, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        result = fn(annot)
+        times.append(time.time() - start)
+    return min(times), result
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    annot = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    pysam_time, pysam_fd = best_time(build_feature_dict_pysam, annot, repeats)
+    stream_time, stream_fd = best_time(build_feature_dict, annot, repeats)
+
+    transcripts = sum([len(pysam_fd[chrom]) for chrom in pysam_fd])
+    print 'transcripts: %d' % transcripts
+    print 'pysam asGTF:      %.2fs' % pysam_time
+    print 'streaming loader: %.2fs (%.1fx)' % (stream_time, pysam_time/stream_time if stream_time else float('inf'))
+    if model_state(pysam_fd) != model_state(stream_fd):
+        sys.exit('feature_dict differs between loaders')
+    print 'feature_dict identical'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""End-to-end benchmark of KLEAT on synthetic data
+
+Generates a data set with synth.py (unless one is already in <datadir>),
+runs KLEAT.py on it with --profile and the stub aligner in bin/ ahead of
+any blat on the PATH, prints the wall time, the time of each stage and the
+fetches through each file handle, and checks the cleavage sites in the
+.KLEAT file against the sites the data set was built with.
+
+Arguments after the known ones are passed on to KLEAT.py, e.g.
+    python bench_pipeline.py /tmp/bench --genes 200 -- -p 4 --prescreen
+
+Exits with status 1 if fewer truth sites than --min_recall are found.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+import synth
+
+INPUTS = ('c2g.bam', 'contigs.fa', 'genome.fa', 'annot.gtf.gz', 'r2c.bam')
+
+def read_truth(path):
+    """[(chrom, site, strand, transcript, kind)] the data set was built with"""
+    truth = []
+    with open(path) as f:
+        for line in f:
+            chrom, site, strand, tid, kind = line.rstrip('\n').split('\t')
+            truth.append((chrom, int(site), strand, tid, kind))
+    return truth
+
+def read_sites(path):
+    """[(chrom, site, transcript)] reported in a .KLEAT file"""
+    with open(path) as f:
+        return [(x['chromosome'], int(x['cleavage_site']), x['transcript']) for x in csv.DictReader(f, delimiter='\t')]
+
+def compare_sites(truth, sites, tolerance):
+    """Returns the truth sites found, those missed and the reported sites near no truth site"""
+    found, missed = [], []
+    for t in truth:
+        if [x for x in sites if x[0] == t[0] and abs(x[1] - t[1]) <= tolerance]:
+            found.append(t)
+        else:
+            missed.append(t)
+    extra = [x for x in sites if not [t for t in truth if x[0] == t[0] and abs(x[1] - t[1]) <= tolerance]]
+    return found, missed, extra
+
+def run_kleat(datadir, out, kleat_args):
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + env.get('PATH', '')
+    cmd = [sys.executable, os.path.join(BENCH_DIR, '..', 'KLEAT.py'), '-ss'] + \
+          [os.path.join(datadir, x) for x in INPUTS] + [out, '--profile'] + kleat_args
+    with open(out + '.log', 'w') as log:
+        start = time.time()
+        status = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        seconds = time.time() - start
+    if status:
+        sys.exit('KLEAT.py exited with status {}, see {}'.format(status, out + '.log'))
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Times KLEAT on a synthetic data set and checks its cleavage sites.')
+    parser.add_argument('datadir', help='Directory of the synthetic data set, generated if it has no truth.tsv.')
+    parser.add_argument('--genes', type=int, default=20, help='Genes per chromosome of a generated data set. Default is 20.')
+    parser.add_argument('--extra', action='store_true', help='Generate unclipped contigs as well, see synth.py.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tolerance', type=int, default=0, help='Distance from the true site a reported site may be. Default is 0.')
+    parser.add_argument('--min_recall', type=float, default=0.0, help='Fraction of the true sites that must be found. Default is 0.')
+    args, kleat_args = parser.parse_known_args()
+    kleat_args = [x for x in kleat_args if x != '--']
+
+    if not os.path.isfile(os.path.join(args.datadir, 'truth.tsv')):
+        start = time.time()
+        synth.generate(args.datadir, args.genes, args.seed, args.extra)
+        print 'generated {} in {:.2f}s'.format(args.datadir, time.time() - start)
+    out = os.path.join(args.datadir, 'bench', 'res')
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    seconds = run_kleat(args.datadir, out, kleat_args)
+
+    with open(out + '.profile.json') as f:
+        profile = json.load(f)
+    print 'KLEAT.py {}: {:.2f}s'.format(' '.join(kleat_args), seconds)
+    print '{:<28}{:>8}{:>10}'.format('stage', 'calls', 'seconds')
+    for name, stage in sorted(profile['stages'].items(), key=lambda x: -x[1]['seconds']):
+        print '{:<28}{:>8}{:>10.3f}'.format(name, stage['calls'], stage['seconds'])
+    print '{:<28}{:>8}{:>10}{:>12}'.format('handle', 'fetches', 'records', 'bytes')
+    for name, handle in sorted(profile['handles'].items()):
+        print '{:<28}{:>8}{:>10}{:>12}'.format(name, handle['fetches'], handle['records'], handle['bytes'])
+
+    truth = read_truth(os.path.join(args.datadir, 'truth.tsv'))
+    found, missed, extra = compare_sites(truth, read_sites(out + '.KLEAT'), args.tolerance)
+    for kind in sorted(set(x[4] for x in truth)):
+        print '{} sites found: {}/{}'.format(kind, len([x for x in found if x[4] == kind]), len([x for x in truth if x[4] == kind]))
+    print 'reported sites not in truth: {}'.format(len(extra))
+    for chrom, site, strand, tid, kind in missed:
+        print 'missed\t{}\t{}\t{}\t{}\t{}'.format(chrom, site, strand, tid, kind)
+    if len(found) < args.min_recall * len(truth):
+        sys.exit('Found {} of {} true sites'.format(len(found), len(truth)))
+
+if __name__ == '__main__':
+    main()
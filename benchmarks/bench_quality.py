@@ -0,0 +1,185 @@
+"""Benchmark of the base quality checks of clipped reads
+
+Compares the per-read checks find_bridge_reads used to make on quality
+strings (sum of the poor quality characters' codes, and regular
+expressions for the poor quality runs to trim from the clipped sequence)
+against quality.ReadQualities, which checks each read with string methods,
+and against NumPy kernels applied to all clipped reads of a contig at once.
+Prints reads/second for each number of reads per contig and checks they
+all agree.
+
+usage: python bench_quality.py [reads per contig,...] [reads per size] [repeats]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+from array import array
+# External modules below
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# In house modules below
+from quality import ReadQualities, QUAL_OFFSET
+
+# KLEAT defaults: --max_poor_bases_in_bridge_read 0 35, --trim 3
+MPB = [0, 35]
+TRIM = 3
+POOR_QUALS = ''.join(chr(i + 33) for i in range(TRIM + 1))
+
+def trim_bases_regex(seq, qual, end=None):
+    """trim_bases as it was"""
+    match_end = re.search(r'[%s]+$' % POOR_QUALS, qual)
+    match_start = re.search(r'^[%s]+' % POOR_QUALS, qual)
+    if match_start and not match_end:
+        if end is None or end == 'start':
+            return seq[match_start.end():]
+    elif match_end and not match_start:
+        if end is None or end == 'end':
+            return seq[:match_end.start()]
+    elif match_start and match_end:
+        if end == 'start':
+            return seq[match_start.end():]
+        elif end == 'end':
+            return seq[:match_end.start()]
+        else:
+            if len(match_start.group()) > len(match_end.group()):
+                return seq[match_start.end():]
+            elif len(match_end.group()) > len(match_start.group()):
+                return seq[:match_end.start()]
+    return seq
+
+def concat_qualities(quals):
+    """Returns the concatenated phred qualities of each read in quals, and the start and end of each read"""
+    lengths = np.fromiter((len(x) for x in quals), dtype=np.int64, count=len(quals))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    joined = np.frombuffer(''.join(x.tostring() for x in quals), dtype=np.uint8)
+    return joined, starts, ends
+
+def poor_quality_sums(quals, starts, ends, max_qual):
+    """Sum, for each read, of the quality characters' codes that are <= max_qual, from a cumulative sum"""
+    codes = np.arange(256, dtype=np.int64) + QUAL_OFFSET
+    codes[codes > max_qual] = 0
+    cumulative = np.zeros(len(quals) + 1, dtype=np.int64)
+    np.cumsum(codes[quals], out=cumulative[1:])
+    return cumulative[ends] - cumulative[starts]
+
+def poor_runs(quals, starts, ends, max_phred):
+    """Lengths of the runs of bases of quality <= max_phred at the start and at the end of each read
+
+    Found from the positions of the good quality bases
+    """
+    good = quals > max_phred
+    # number of good bases before each position, and where they are
+    good_before = np.zeros(len(quals) + 1, dtype=np.int64)
+    np.cumsum(good, out=good_before[1:])
+    good = np.append(np.flatnonzero(good), 0)
+    num_good = good_before[ends] - good_before[starts]
+    # reads without good bases are poor from end to end
+    lead = np.where(num_good > 0, good[good_before[starts]] - starts, ends - starts)
+    trail = np.where(num_good > 0, ends - 1 - good[good_before[ends] - 1], ends - starts)
+    return lead, trail
+
+class BatchQualities(object):
+    """ReadQualities with the kernels above, all reads of a contig at once"""
+
+    def __init__(self, quals):
+        self.quals, self.starts, self.ends = concat_qualities(quals)
+
+    def poor_quality_sums(self, max_qual):
+        return poor_quality_sums(self.quals, self.starts, self.ends, max_qual).tolist()
+
+    def poor_runs(self, max_phred):
+        lead, trail = poor_runs(self.quals, self.starts, self.ends, max_phred)
+        return lead.tolist(), trail.tolist()
+
+def make_contig_reads(num_reads):
+    """[(clipped_pos, clip length, seq, phred qualities)] of random clipped reads"""
+    reads = []
+    for i in range(num_reads):
+        length = 100
+        quals = array('B', [random.randint(10, 40) for j in range(length)])
+        # runs of poor quality bases, to be trimmed, at either end of some reads
+        for j in range(random.choice((0, 0, 3, 10))):
+            quals[j] = TRIM
+        for j in range(random.choice((0, 0, 5, 20))):
+            quals[-1 - j] = TRIM
+        # and a base poor enough to reject the read in some
+        if random.random() < 0.1:
+            quals[random.randrange(length)] = 2
+        seq = ''.join(random.choice('ACGT') for j in range(length))
+        reads.append((random.choice(('start', 'end')), random.randint(1, 40), seq, quals))
+    return reads
+
+def clipped_seqs_strings(reads):
+    """The per-read version"""
+    result = []
+    cutoff = MPB[0] * MPB[1]
+    for clipped_pos, clip, seq, qual in reads:
+        if clipped_pos == 'start':
+            clipped_seq, clipped_qual = seq[:clip], qual[:clip]
+        else:
+            clipped_seq, clipped_qual = seq[-clip:], qual[-clip:]
+        if sum([ord(x) for x in qual if ord(x) <= MPB[1]]) > cutoff:
+            result.append(None)
+            continue
+        result.append(trim_bases_regex(clipped_seq, clipped_qual, clipped_pos))
+    return result
+
+def clipped_seqs_quality(reads, qualities_class=ReadQualities):
+    """The ReadQualities version, or that of another class with its methods"""
+    result = []
+    cutoff = MPB[0] * MPB[1]
+    qualities = qualities_class([x[3] for x in reads])
+    poor_sums = qualities.poor_quality_sums(MPB[1])
+    poor_start, poor_end = qualities.poor_runs(TRIM)
+    for i, (clipped_pos, clip, seq, qual) in enumerate(reads):
+        if poor_sums[i] > cutoff:
+            result.append(None)
+            continue
+        if clipped_pos == 'start':
+            clipped_seq = seq[:clip]
+            result.append(clipped_seq[min(poor_start[i], len(clipped_seq)):])
+        else:
+            clipped_seq = seq[-clip:]
+            result.append(clipped_seq[:len(clipped_seq) - min(poor_end[i], len(clipped_seq))])
+    return result
+
+VERSIONS = [('per read', clipped_seqs_quality),
+            ('batch', lambda x: clipped_seqs_quality(x, BatchQualities))]
+
+def best_time(fn, contigs, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        result = [fn(x) for x in contigs]
+        times.append(time.time() - start)
+    return min(times), result
+
+def main():
+    sizes = [int(x) for x in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1, 2, 3, 4, 5, 20, 100, 1000, 2000, 5000]
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    random.seed(1)
+    print 'reads/s of the clipped reads quality checks'
+    print '%6s %12s' % ('reads', 'strings') + ''.join('%18s' % x[0] for x in VERSIONS)
+    for num_reads in sizes:
+        num_contigs = max(2, total / num_reads)
+        contigs = [make_contig_reads(num_reads) for i in range(num_contigs)]
+        # the checks look at qualities as strings, as pysam's read.qual gives them
+        contigs_strings = [[(p, c, s, ''.join(chr(x + 33) for x in q)) for p, c, s, q in reads] for reads in contigs]
+        string_time, string_result = best_time(clipped_seqs_strings, contigs_strings, repeats)
+        row = '%6d %12.0f' % (num_reads, num_reads * num_contigs / string_time)
+        for name, fn in VERSIONS:
+            fn_time, fn_result = best_time(fn, contigs, repeats)
+            if fn_result != string_result:
+                sys.exit('clipped sequences differ between strings and %s' % name)
+            row += '%12.0f (%.1fx)' % (num_reads * num_contigs / fn_time, string_time / fn_time)
+        print row
+    print 'clipped sequences identical'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark of the reverse complement of sequences
+
+Compares revComp as it was (a dict lookup and a string concatenation per
+nucleotide) against sequence.py at its call sites: clipped read sequences
+one at a time and all of a contig at once (reverse_complements), and the
+hexamers of the 100 bp window findBindingSites searches, one reverse
+complement per position against slices of the reversed window. Prints
+sequences/second for each and checks they agree.
+
+usage: python bench_revcomp.py [clipped reads per contig] [contigs] [repeats]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# In house modules below
+from sequence import reverse_complement, reverse_complements
+
+WINDOW = 100
+
+def revcomp_dict(seq):
+    """revComp as it was"""
+    seq = seq.upper()
+    ndic = {'A':'T','T':'A','C':'G','G':'C','N':'N'}
+    revcomp = ''
+    for nuc in seq:
+        revcomp += ndic[nuc]
+    return revcomp[::-1]
+
+def random_seq(length):
+    return ''.join(random.choice('ACGTN' if random.random() < 0.01 else 'ACGT') for i in range(length))
+
+def clipped_dict(contig):
+    return [revcomp_dict(x) for x in contig]
+
+def clipped_single(contig):
+    return [reverse_complement(x, upper=True) for x in contig]
+
+def clipped_batch(contig):
+    return reverse_complements(contig, upper=True)
+
+def hexamers_dict(seq):
+    """Reverse complemented hexamers of a window, as findBindingSites made them"""
+    return [revcomp_dict(seq[i:i+6]) for i in xrange(len(seq))]
+
+def hexamers_window(seq):
+    """The same hexamers sliced out of the reverse complemented window"""
+    rev_seq = reverse_complement(seq, upper=True)
+    return [rev_seq[max(len(seq)-i-6, 0):len(seq)-i] for i in xrange(len(seq))]
+
+def best_time(fn, items, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        result = [fn(x) for x in items]
+        times.append(time.time() - start)
+    return min(times), result
+
+def main():
+    num_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    num_contigs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    random.seed(1)
+    contigs = [[random_seq(random.randint(1, 60)) for i in range(num_reads)] for j in range(num_contigs)]
+    windows = [random_seq(WINDOW) for i in range(num_contigs)]
+
+    total = num_reads * num_contigs
+    print 'clipped sequences: %d in %d contigs' % (total, num_contigs)
+    dict_time, dict_result = best_time(clipped_dict, contigs, repeats)
+    print 'dict lookups:         %10.0f seqs/s' % (total / dict_time)
+    for name, fn in (('translate, per read:', clipped_single), ('translate, batch:', clipped_batch)):
+        fn_time, fn_result = best_time(fn, contigs, repeats)
+        print '%-21s %10.0f seqs/s (%.1fx)' % (name, total / fn_time, dict_time / fn_time)
+        if fn_result != dict_result:
+            sys.exit('reverse complements differ between versions')
+
+    print 'binding site windows: %d of %d bp' % (num_contigs, WINDOW)
+    dict_time, dict_result = best_time(hexamers_dict, windows, repeats)
+    window_time, window_result = best_time(hexamers_window, windows, repeats)
+    print 'per hexamer (dict):   %10.0f windows/s' % (num_contigs / dict_time)
+    print 'window slices:        %10.0f windows/s (%.1fx)' % (num_contigs / window_time, dict_time / window_time)
+    if window_result != dict_result:
+        sys.exit('hexamers differ between versions')
+    print 'reverse complements identical'
+
+if __name__ == '__main__':
+    main()
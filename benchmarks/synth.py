@@ -0,0 +1,181 @@
+"""Synthetic input files for benchmarking KLEAT
+
+Writes a random two-chromosome genome, a GTF with three-exon transcripts
+(plus shorter noncoding and identical-span isoforms on some genes), one
+contig per gene covering the last 600bp of its 3' end, the contigs-to-genome
+and reads-to-contigs BAMs, and truth.tsv with the cleavage site each contig
+was built to show.
+
+Genes alternate in strand. Half of the contigs end in a 20bp poly(A) tail
+with reads running into it (tail evidence), the other half have no tail and
+reads whose soft clipped ends are poly(A) (bridge evidence). With --extra,
+each gene also gets an unclipped contig over its middle exon, with clipped
+poly(A) reads on every other gene, which only the pre-screen can discard.
+The sites those reads show are not in truth.tsv.
+
+usage: python synth.py <outdir> [genes] [--extra] [--seed N]
+"""
+
+import os
+import sys
+import random
+import argparse
+# External modules below
+import pysam
+
+COMP = {'A':'T','C':'G','G':'C','T':'A'}
+
+TAIL_LENGTH = 20
+CONTIG_LENGTH = 600
+READ_LENGTH = 100
+
+def rc(seq):
+    return ''.join(COMP[x] for x in reversed(seq))
+
+def write_fasta(path, seqs, width=None):
+    with open(path, 'w') as out:
+        for name, seq in seqs:
+            out.write('>{}\n'.format(name))
+            step = width or len(seq)
+            for i in xrange(0, len(seq), step):
+                out.write(seq[i:i+step] + '\n')
+    pysam.faidx(path)
+
+def write_bam(path, references, records):
+    """Writes the sorted, indexed BAM of records (reference, name, pos, reverse, cigar, seq)"""
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': length} for name, length in references]}
+    ids = dict((name, i) for i, (name, length) in enumerate(references))
+    reads = []
+    for reference, name, pos, reverse, cigar, seq in records:
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.query_sequence = seq
+        read.flag = 16 if reverse else 0
+        read.reference_id = ids[reference]
+        read.reference_start = pos
+        read.mapping_quality = 60
+        read.cigartuples = cigar
+        read.query_qualities = pysam.qualitystring_to_array('I'*len(seq))
+        reads.append(read)
+    reads.sort(key=lambda x: (x.reference_id, x.reference_start))
+    with pysam.AlignmentFile(path, 'wb', header=header) as out:
+        for read in reads:
+            out.write(read)
+    pysam.index(path)
+
+def make_gene(chrom, seq, g, n, gtf, contigs, c2g, r2c, truth, extra):
+    """Adds the annotation, contigs and reads of gene number n (g-th on chrom)"""
+    strand = '+' if g % 2 == 0 else '-'
+    gstart = 5000 + g*6000
+    exons = [(gstart, gstart+300), (gstart+1000, gstart+1400), (gstart+2000, gstart+3000)]
+    tid, gid = 'T%04d' % n, 'G%04d' % n
+    if strand == '+':
+        cds = (exons[0][0]+50, exons[2][0]+200)
+    else:
+        cds = (exons[0][1]-100, exons[2][1]-50)
+
+    def add_transcript(tid, exons, coding):
+        attr = 'gene_id "%s"; transcript_id "%s";' % (gid, tid)
+        for start, end in exons:
+            gtf.append((chrom, start, end, 'exon', strand, attr))
+        if coding:
+            for start, end in exons:
+                cstart, cend = max(start, cds[0]), min(end, cds[1])
+                if cstart < cend:
+                    gtf.append((chrom, cstart, cend, 'CDS', strand, attr))
+
+    add_transcript(tid, exons, True)
+    if g % 3 == 0:
+        # Noncoding isoform ending 200bp short of the main one
+        if strand == '+':
+            add_transcript(tid+'b', exons[:2] + [(exons[2][0], exons[2][1]-200)], False)
+        else:
+            add_transcript(tid+'b', [(exons[0][0]+200, exons[0][1])] + exons[1:], False)
+    if g % 5 == 0:
+        # Isoform with the same span, to create ties
+        add_transcript(tid+'c', exons, True)
+
+    # Contig over the last 600bp of the transcript's 3' end
+    tstart, tend = exons[0][0], exons[-1][1]
+    kind = 'tail' if g % 4 < 2 else 'bridge'
+    if strand == '+':
+        cstart = tend - CONTIG_LENGTH
+        body = seq[cstart:tend]
+        site = tend
+    else:
+        cstart = tstart
+        body = rc(seq[tstart:tstart+CONTIG_LENGTH])
+        site = tstart + 1
+    name = 'k%d' % n
+    tail = 'A'*TAIL_LENGTH if kind == 'tail' else ''
+    contig = body + tail
+    contigs.append((name, contig))
+    if strand == '+':
+        c2g.append((chrom, name, cstart, False, [(0, CONTIG_LENGTH)] + ([(4, TAIL_LENGTH)] if tail else []), contig))
+    else:
+        c2g.append((chrom, name, cstart, True, ([(4, TAIL_LENGTH)] if tail else []) + [(0, CONTIG_LENGTH)], rc(contig)))
+
+    # Reads in contig coordinates and orientation
+    for i in xrange(0, CONTIG_LENGTH-READ_LENGTH, 25):
+        r2c.append((name, 'r%s_%d' % (name, i), i, False, [(0, READ_LENGTH)], contig[i:i+READ_LENGTH]))
+    if kind == 'tail':
+        for k in range(3):
+            pos = CONTIG_LENGTH - 60 + k*5
+            r2c.append((name, 't%s_%d' % (name, k), pos, False, [(0, min(READ_LENGTH, len(contig)-pos))], contig[pos:pos+READ_LENGTH]))
+    else:
+        for k in range(4):
+            matched = 80 - k*5
+            r2c.append((name, 'b%s_%d' % (name, k), CONTIG_LENGTH-matched, False, [(0, matched), (4, READ_LENGTH-matched)],
+                        contig[CONTIG_LENGTH-matched:] + 'A'*(READ_LENGTH-matched)))
+    truth.append((chrom, site, strand, tid, kind))
+
+    if extra:
+        name = 'p%d' % n
+        start, end = exons[1]
+        contig = seq[start:end] if strand == '+' else rc(seq[start:end])
+        contigs.append((name, contig))
+        c2g.append((chrom, name, start, strand == '-', [(0, end-start)], seq[start:end]))
+        for i in xrange(0, end-start-READ_LENGTH, 50):
+            r2c.append((name, 'r%s_%d' % (name, i), i, False, [(0, READ_LENGTH)], contig[i:i+READ_LENGTH]))
+        if g % 2 == 0:
+            for k in range(3):
+                r2c.append((name, 'b%s_%d' % (name, k), 200, False, [(0, 70), (4, 30)], contig[200:270] + 'A'*30))
+
+def generate(outdir, genes=20, seed=1, extra=False):
+    """Writes the synthetic data set with genes genes per chromosome to outdir"""
+    random.seed(seed)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    chroms = [(chrom, ''.join(random.choice('ACGT') for i in xrange(genes*6000+10000))) for chrom in ('chr1', 'chr2')]
+    write_fasta(os.path.join(outdir, 'genome.fa'), chroms, width=60)
+
+    gtf, contigs, c2g, r2c, truth = [], [], [], [], []
+    n = 0
+    for chrom, seq in chroms:
+        for g in xrange(genes):
+            n += 1
+            make_gene(chrom, seq, g, n, gtf, contigs, c2g, r2c, truth, extra)
+
+    gtf.sort(key=lambda x: (x[0], x[1]))
+    with open(os.path.join(outdir, 'annot.gtf'), 'w') as out:
+        for chrom, start, end, feature, strand, attr in gtf:
+            out.write('%s\tsynth\t%s\t%d\t%d\t.\t%s\t.\t%s\n' % (chrom, feature, start+1, end, strand, attr))
+    pysam.tabix_index(os.path.join(outdir, 'annot.gtf'), preset='gff', force=True)
+    write_fasta(os.path.join(outdir, 'contigs.fa'), contigs)
+    write_bam(os.path.join(outdir, 'c2g.bam'), [(chrom, len(seq)) for chrom, seq in chroms], c2g)
+    write_bam(os.path.join(outdir, 'r2c.bam'), [(name, len(seq)) for name, seq in contigs], r2c)
+    with open(os.path.join(outdir, 'truth.tsv'), 'w') as out:
+        for row in truth:
+            out.write('\t'.join(map(str, row)) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes a synthetic KLEAT data set.')
+    parser.add_argument('outdir')
+    parser.add_argument('genes', type=int, nargs='?', default=20, help='Genes per chromosome. Default is 20.')
+    parser.add_argument('--extra', action='store_true', help='Add unclipped contigs over the middle exons.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(args.outdir, args.genes, args.seed, args.extra)
+
+if __name__ == '__main__':
+    main()
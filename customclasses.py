@@ -1,21 +1,74 @@
-class Transcript:
-    
-    def __init__(self, name, chrom, tid, strand, cstart, cend, tstart, tend):
-        self.name = name
-        self.chrom = chrom
+from array import array
+
+class Transcript(object):
+    """Annotated transcript
+
+    Exon coordinates are kept in two integer arrays (0-based starts,
+    1-based ends) and there is no per-instance __dict__, to keep the
+    annotation model small.
+    """
+
+    __slots__ = ('tid', 'chrom', 'gene_id', 'strand', 'tstart', 'tend',
+                 'cstart', 'cend', 'utr3', 'exon_starts', 'exon_ends', 'cleavage_sites')
+
+    def __init__(self, tid, chrom, tstart, tend, strand=None, gene_id=None, cstart=None, cend=None):
         self.tid = tid
+        self.chrom = chrom
+        self.gene_id = intern(gene_id) if gene_id is not None else None
         self.strand = strand
-        self.cstart = cstart
-        self.cend = cend
         self.tstart = tstart
         self.tend = tend
-        self.seq = None
+        self.cstart = cstart
+        self.cend = cend
+        self.utr3 = None
+        self.exon_starts = array('i')
+        self.exon_ends = array('i')
+        # Cleavage sites assigned to this transcript during a run
+        self.cleavage_sites = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in self.__slots__)
+
+    def __setstate__(self, state):
+        for x, value in zip(self.__slots__, state):
+            setattr(self, x, value)
+
+    @property
+    def exons(self):
+        return zip(self.exon_starts, self.exon_ends)
+
+    def add_exon(self, start, end):
+        self.exon_starts.append(start)
+        self.exon_ends.append(end)
+
+    def overlaps_exon(self, start, end):
+        """Whether any exon overlaps [start, end), the span is used if there are no exons"""
+        if not self.exon_starts:
+            return self.tstart < end and self.tend > start
+        for i in xrange(len(self.exon_starts)):
+            if self.exon_starts[i] < end and self.exon_ends[i] > start:
+                return True
+        return False
 
     def get_utr3(self):
-        if self.cend and (self.tend > self.cend+3):
-            return [self.cend+3,self.tend]
+        """Returns the 3'UTR inferred from the CDS and transcript ends, or None"""
+        if (self.strand == '+'):
+            if (self.cend) and (self.tend > self.cend+3):
+                # Plus 3 to first coordinate to account for stop codon
+                return [self.cend+3,self.tend]
         else:
-            return None
+            if (self.cstart) and (self.tstart < (self.cstart-3)):
+                # Minus 3 to last coordinate to account for stop codon
+                return [self.tstart,self.cstart-3]
+        return None
+
+    def add_cleavage_site(self, cleavage_site):
+        if self.cleavage_sites is None:
+            self.cleavage_sites = []
+        self.cleavage_sites.append(cleavage_site)
+
+    def get_cleavage_sites(self):
+        return self.cleavage_sites or []
 
 class Contig:
     
@@ -0,0 +1,114 @@
+"""Append-only journal of per-contig results used by KLEAT --resume
+
+Every record is framed by its length and CRC32 so that a record torn by
+a crash is detected and dropped when the journal is read back. Records
+are flushed to disk in batches to keep the fsync overhead small; the
+contigs of an unsynced batch are simply analysed again on resume. The
+journal is removed once the results of the run are written.
+"""
+
+import os
+import time
+import zlib
+import struct
+import cPickle
+
+JOURNAL_VERSION = 1
+FRAME = struct.Struct('<II')
+COMPLETE = 'complete'
+
+class JournalError(Exception):
+    pass
+
+class Journal(object):
+    """Per-contig result journal
+
+    The first record is a header holding the run parameters, a journal is
+    only resumed by a run with the same parameters.
+    """
+
+    def __init__(self, path, params, sync_records=100, sync_interval=2.0):
+        self.path = path
+        self.params = params
+        self.sync_records = sync_records
+        self.sync_interval = sync_interval
+        self.handle = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def read(self):
+        """Returns the records of an existing journal and whether it is complete
+
+        A torn record and everything after it is cut from the file.
+        """
+        records = []
+        complete = False
+        with open(self.path, 'rb') as f:
+            offset = 0
+            while True:
+                frame = f.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break
+                size, crc = FRAME.unpack(frame)
+                data = f.read(size)
+                if len(data) < size or (zlib.crc32(data) & 0xffffffff) != crc:
+                    break
+                offset = f.tell()
+                records.append(cPickle.loads(data))
+        if os.path.getsize(self.path) != offset:
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        if not records or records[0] != {'version': JOURNAL_VERSION, 'params': self.params}:
+            raise JournalError('{} was written by a run with different parameters'.format(self.path))
+        records = records[1:]
+        if records and records[-1] == COMPLETE:
+            complete = True
+            records.pop()
+        return records, complete
+
+    def open(self, resume=False):
+        """Opens the journal for appending, returns the records to resume from"""
+        records, complete = [], False
+        if resume and os.path.isfile(self.path):
+            records, complete = self.read()
+            self.handle = open(self.path, 'ab')
+        else:
+            self.handle = open(self.path, 'wb')
+            self.write({'version': JOURNAL_VERSION, 'params': self.params})
+            self.sync()
+        return records, complete
+
+    def write(self, record):
+        data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        self.handle.write(FRAME.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self.handle.write(data)
+        self.unsynced += 1
+
+    def append(self, record):
+        """Appends a record, syncing once enough records or time have accumulated"""
+        self.write(record)
+        if self.unsynced >= self.sync_records or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def finish(self):
+        """Marks every contig as analysed"""
+        self.write(COMPLETE)
+        self.sync()
+
+    def close(self):
+        if self.handle is not None:
+            self.sync()
+            self.handle.close()
+            self.handle = None
+
+    def remove(self):
+        """Closes and deletes the journal, once there is nothing left to resume"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
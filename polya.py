@@ -0,0 +1,58 @@
+"""Poly(A)/poly(T) classification of clipped sequences, many at a time
+
+Each sequence is classified from the number of times the expected base
+occurs in it (either case), counted with str.count, with the semantics of
+KLEAT's is_polyA_tail and is_bridge_read_good:
+
+- a sequence is a possible tail when it contains the expected base in
+  upper case, has at least min_len of it, and the ratio of the expected
+  to the other bases is not below max_nonAT_allowed[1]/max_nonAT_allowed[0]
+  (any other base fails when max_nonAT_allowed[0] is 0)
+- a bridge read is good when its clipped sequence is one character repeated
+  (case sensitive) that is the base in upper case, or a possible tail
+"""
+
+def base_counts(seqs, base):
+    """Number of times base occurs in each sequence, in either case"""
+    upper, lower = base.upper(), base.lower()
+    return [seq.count(upper) + seq.count(lower) for seq in seqs]
+
+def polyA_tails(seqs, expected_base, min_len, max_nonAT_allowed, counts=None):
+    """Whether each sequence can be a tail of expected_base, as is_polyA_tail decides"""
+    if counts is None:
+        counts = base_counts(seqs, expected_base) if expected_base is not None else [0] * len(seqs)
+    min_ratio = None
+    result = []
+    for seq, count in zip(seqs, counts):
+        if seq is None or seq == '' or expected_base is None or not expected_base in seq:
+            result.append(False)
+            continue
+        if count < min_len:
+            result.append(False)
+            continue
+        non_base = len(seq) - count
+        if max_nonAT_allowed[0] == 0 and non_base > 0:
+            result.append(False)
+            continue
+        if non_base == 0:
+            result.append(True)
+            continue
+        if min_ratio is None:
+            min_ratio = max_nonAT_allowed[1]/max_nonAT_allowed[0]
+        result.append(not float(count)/non_base < min_ratio)
+    return result
+
+def good_bridge_reads(seqs, base, min_len, mismatch, counts=None):
+    """Whether each clipped sequence makes a good bridge read for base, as is_bridge_read_good decides"""
+    if counts is None:
+        counts = base_counts(seqs, base)
+    tails = polyA_tails(seqs, base, min_len, mismatch, counts=counts)
+    return [(seq[0].upper() == base and seq.count(seq[0]) == len(seq)) or tail for seq, tail in zip(seqs, tails)]
+
+def classify_clipped(seqs, min_len, mismatch, bases=('A', 'T')):
+    """Returns {base: (good bridge read of each sequence, count of base in each sequence)}"""
+    classes = {}
+    for base in bases:
+        counts = base_counts(seqs, base)
+        classes[base] = (good_bridge_reads(seqs, base, min_len, mismatch, counts=counts), counts)
+    return classes
@@ -0,0 +1,59 @@
+"""Background loading of per-contig input data used by KLEAT"""
+
+import sys
+import threading
+import Queue
+
+class Prefetcher(object):
+    """Iterates over items while a background thread loads the data of the next ones
+
+    Yields (item, load(handles, item)) in the order of items. At most size
+    loaded items wait in the queue, which caps the memory used. handles is
+    the result of calling open_handles() in the loading thread, so the
+    thread does not share file handles with the caller.
+    """
+
+    def __init__(self, items, load, open_handles=None, size=8):
+        self.items = items
+        self.load = load
+        self.open_handles = open_handles
+        self.size = size
+        self.stop = threading.Event()
+
+    def put(self, queue, entry):
+        """Waits for room in the queue unless the caller stopped iterating"""
+        while not self.stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce(self, queue):
+        try:
+            handles = self.open_handles() if self.open_handles else None
+            for item in self.items:
+                if not self.put(queue, ('item', (item, self.load(handles, item)))):
+                    return
+        except Exception:
+            self.put(queue, ('error', sys.exc_info()))
+            return
+        self.put(queue, ('done', None))
+
+    def __iter__(self):
+        queue = Queue.Queue(self.size)
+        thread = threading.Thread(target=self.produce, args=(queue,))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                kind, value = queue.get()
+                if kind == 'done':
+                    break
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                yield value
+        finally:
+            self.stop.set()
+            thread.join()
@@ -0,0 +1,51 @@
+"""Pre-screen of contigs that cannot produce tail or bridge read evidence
+
+Bridge reads are reads aligned to a contig with exactly one clipped end.
+The number of such reads per contig is counted in one pass over the
+reads-to-contigs alignment and kept in a binary index next to it, tied to
+the alignment file by its signature (see signedfile.py).
+"""
+
+import logging
+
+import pysam
+
+from signedfile import read_signed_pickle, write_signed_pickle
+
+logger = logging.getLogger('polyA_logger')
+
+CLIP_INDEX_VERSION = 2
+CLIP_INDEX_SUFFIX = '.kleat_clips'
+
+# Counters of the pre-screen rules, in reporting order
+RULES = ('screened', 'unclipped', 'far_from_ends')
+
+def count_clipped_reads(r2c):
+    """Returns {contig: number of reads with one clipped end, as find_bridge_reads looks at}"""
+    bam = pysam.AlignmentFile(r2c, 'rb')
+    counts = [0] * bam.nreferences
+    for read in bam.fetch(until_eof=True):
+        cigar = read.cigartuples
+        if not cigar or len(cigar) != 2 or read.reference_id < 0:
+            continue
+        if cigar[0][0] in (4, 5) or cigar[-1][0] in (4, 5):
+            counts[read.reference_id] += 1
+    clip_counts = dict((bam.references[i], x) for i, x in enumerate(counts) if x)
+    bam.close()
+    return clip_counts
+
+def load_clip_counts(r2c, index_path=None):
+    """Returns the clipped read counts of r2c, using (and refreshing) the on-disk index
+
+    index_path defaults to the r2c path plus '.kleat_clips'.
+    """
+    if index_path is None:
+        index_path = r2c + CLIP_INDEX_SUFFIX
+    clip_counts = read_signed_pickle(index_path, CLIP_INDEX_VERSION, r2c, 'Clipped read index')
+    if clip_counts is not None:
+        logger.debug('Loaded clipped read index %s', index_path)
+        return clip_counts
+    clip_counts = count_clipped_reads(r2c)
+    if write_signed_pickle(index_path, CLIP_INDEX_VERSION, r2c, clip_counts, 'Clipped read index'):
+        logger.debug('Wrote clipped read index %s', index_path)
+    return clip_counts
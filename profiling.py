@@ -0,0 +1,137 @@
+"""Per-stage profiling used by KLEAT --profile
+
+Records the wall time and number of calls of each stage, the calls,
+records and sequence bytes fetched through each pysam handle, and the
+slowest contigs, and writes them as a JSON report.
+"""
+
+import time
+import json
+import heapq
+import functools
+import threading
+from contextlib import contextmanager
+
+class CountingFasta(object):
+    """pysam.FastaFile whose fetches are counted"""
+
+    def __init__(self, fasta, counts):
+        self.fasta = fasta
+        self.counts = counts
+
+    def fetch(self, *args, **kwargs):
+        seq = self.fasta.fetch(*args, **kwargs)
+        self.counts[0] += 1
+        self.counts[1] += 1
+        self.counts[2] += len(seq)
+        return seq
+
+    def __getattr__(self, name):
+        return getattr(self.fasta, name)
+
+class CountingAlignmentFile(object):
+    """pysam.AlignmentFile whose fetches and the records they return are counted"""
+
+    def __init__(self, bam, counts):
+        self.bam = bam
+        self.counts = counts
+
+    def fetch(self, *args, **kwargs):
+        self.counts[0] += 1
+        for read in self.bam.fetch(*args, **kwargs):
+            self.counts[1] += 1
+            self.counts[2] += read.query_length
+            yield read
+
+    def __getattr__(self, name):
+        return getattr(self.bam, name)
+
+class Profiler(object):
+    """Collects the timings and counts of one run
+
+    State from worker processes is added with merge(state()).
+    """
+
+    def __init__(self, top=20):
+        self.top = top
+        self.start = time.time()
+        # name: [fetches, records, bytes], shared with the counting handles
+        self.handles = {}
+        # stages can be added from threads (blat chunks)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # name: [calls, seconds]
+        self.stages = {}
+        # heap of the slowest (seconds, contig)
+        self.contigs = []
+        for counts in self.handles.values():
+            counts[:] = [0, 0, 0]
+
+    def add_stage(self, name, seconds, calls=1):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = [0, 0.0]
+            self.stages[name][0] += calls
+            self.stages[name][1] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.time() - start)
+
+    def wrap(self, name, fn):
+        """Returns fn timed as stage name"""
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add_stage(name, time.time() - start)
+        return timed
+
+    def add_contig(self, seconds, contig):
+        if len(self.contigs) < self.top:
+            heapq.heappush(self.contigs, (seconds, contig))
+        elif seconds > self.contigs[0][0]:
+            heapq.heapreplace(self.contigs, (seconds, contig))
+
+    def handle_counts(self, name):
+        if name not in self.handles:
+            self.handles[name] = [0, 0, 0]
+        return self.handles[name]
+
+    def fasta(self, name, fasta):
+        return CountingFasta(fasta, self.handle_counts(name))
+
+    def bam(self, name, bam):
+        return CountingAlignmentFile(bam, self.handle_counts(name))
+
+    def state(self):
+        return {'stages': self.stages, 'handles': self.handles, 'contigs': self.contigs}
+
+    def merge(self, state):
+        for name, (calls, seconds) in state['stages'].items():
+            self.add_stage(name, seconds, calls)
+        for name, counts in state['handles'].items():
+            total = self.handle_counts(name)
+            for i in range(len(total)):
+                total[i] += counts[i]
+        for seconds, contig in state['contigs']:
+            self.add_contig(seconds, contig)
+
+    def report(self):
+        return {'total_seconds': round(time.time() - self.start, 6),
+                'stages': dict((k, {'calls': v[0], 'seconds': round(v[1], 6)}) for k, v in self.stages.items()),
+                'handles': dict((k, {'fetches': v[0], 'records': v[1], 'bytes': v[2]}) for k, v in self.handles.items()),
+                'slowest_contigs': [{'contig': c, 'seconds': round(s, 6)} for s, c in sorted(self.contigs, reverse=True)]}
+
+    def write(self, out_file):
+        with open(out_file, 'w') as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True)
+            out.write('\n')
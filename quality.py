@@ -0,0 +1,44 @@
+"""Base quality checks of clipped reads, with string methods on each read's qualities
+
+The phred qualities of each read are kept as a string of raw (unoffset)
+quality characters, and the poor quality ones are deleted or stripped with
+str.translate, lstrip and rstrip. benchmarks/bench_quality.py finds this
+faster than NumPy kernels over all clipped reads of a contig at every
+number of reads it measures.
+"""
+
+import math
+
+# Offset of the quality characters in SAM/BAM files (Sanger)
+QUAL_OFFSET = 33
+
+# {max_phred: characters}, the tables are built once per threshold
+_phred_chars = {}
+
+def phred_chars(max_phred):
+    """Characters of the phred qualities <= max_phred, in raw (unoffset) quality strings"""
+    if max_phred not in _phred_chars:
+        _phred_chars[max_phred] = ''.join(chr(i) for i in range(max(0, min(int(math.floor(max_phred)) + 1, 256))))
+    return _phred_chars[max_phred]
+
+class ReadQualities(object):
+    """Phred qualities of the reads of a contig, for poor_quality_sums and poor_runs"""
+
+    def __init__(self, quals):
+        self.quals = [x.tostring() for x in quals]
+
+    def poor_quality_sums(self, max_qual):
+        """Sum, for each read, of the quality characters' codes that are <= max_qual
+
+        Same as sum([ord(x) for x in read.qual if ord(x) <= max_qual]) for each read.
+        """
+        # the good qualities are deleted, leaving the poor ones
+        good = phred_chars(255).translate(None, phred_chars(max_qual - QUAL_OFFSET))
+        return [sum(bytearray(x)) + QUAL_OFFSET * len(x) for x in (qual.translate(None, good) for qual in self.quals)]
+
+    def poor_runs(self, max_phred):
+        """Lengths of the runs of bases of quality <= max_phred at the start and at the end of each read"""
+        poor = phred_chars(max_phred)
+        lead = [len(x) - len(x.lstrip(poor)) for x in self.quals]
+        trail = [len(x) - len(x.rstrip(poor)) for x in self.quals]
+        return lead, trail
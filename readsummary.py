@@ -0,0 +1,124 @@
+"""Summary of the reads aligned to one contig
+
+The reads of a contig are decoded once, in a single pass over the
+reads-to-contigs alignment, into the little that the analysis looks at:
+the span of every read aligned without clipping (for counting the reads
+that span a cleavage site) and a light record of every read clipped at one
+end (for finding bridge reads).
+
+The number of unclipped reads spanning a position is answered from
+cumulative counts of read starts and ends over the contig positions, built
+the first time it is asked for: a read spans position p when it starts
+before p and ends after it, and every read ending at or before p starts
+before it, so the count is starts[p-1] - ends[p].
+"""
+
+from array import array
+from collections import namedtuple
+# External modules below
+import numpy as np
+# In house modules below
+from quality import ReadQualities
+
+# The fields of a pysam.AlignedSegment that find_bridge_reads reads, under the same names,
+# and the phred qualities of the read (query_qualities)
+ClippedRead = namedtuple('ClippedRead', ('qname', 'pos', 'alen', 'cigar', 'seq', 'quals'))
+
+# Soft and hard clipping CIGAR operations
+CLIP_OPS = (4, 5)
+
+class ContigReads(object):
+    """Reads aligned to a contig
+
+    matched_starts and matched_ends are the 0-based start and end of each
+    read aligned with a single CIGAR operation, clipped holds a ClippedRead
+    for each read of two CIGAR operations with a clipped end.
+    starts_upto and ends_upto are the cumulative counts of matched reads
+    starting and ending at or before each contig position.
+    """
+
+    __slots__ = ('matched_starts', 'matched_ends', 'clipped', 'starts_upto', 'ends_upto')
+    # The spanning read index is rebuilt rather than stored
+    state_slots = ('matched_starts', 'matched_ends', 'clipped')
+
+    def __init__(self, reads=()):
+        self.matched_starts = array('i')
+        self.matched_ends = array('i')
+        self.clipped = []
+        self.starts_upto = self.ends_upto = None
+        for read in reads:
+            self.add(read)
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in self.state_slots)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.state_slots, state):
+            setattr(self, name, value)
+        self.starts_upto = self.ends_upto = None
+
+    def __len__(self):
+        return len(self.matched_starts) + len(self.clipped)
+
+    def add(self, read):
+        cigar = read.cigartuples
+        if not cigar:
+            return
+        if len(cigar) == 1:
+            # reads covering no contig base span no position
+            if read.reference_length > 0:
+                self.matched_starts.append(read.reference_start)
+                self.matched_ends.append(read.reference_start + read.reference_length)
+                self.starts_upto = self.ends_upto = None
+        elif len(cigar) == 2 and (cigar[0][0] in CLIP_OPS or cigar[-1][0] in CLIP_OPS):
+            self.clipped.append(ClippedRead(read.query_name, read.reference_start, read.reference_length,
+                                            cigar, read.query_sequence, read.query_qualities or array('B')))
+
+    def clipped_qualities(self):
+        """Phred qualities of the clipped reads, as a quality.ReadQualities"""
+        return ReadQualities([x.quals for x in self.clipped])
+
+    def build_spanning_index(self):
+        size = max(self.matched_ends) + 1 if self.matched_ends else 1
+        self.starts_upto = np.cumsum(np.bincount(np.asarray(self.matched_starts, dtype=np.int64), minlength=size))
+        self.ends_upto = np.cumsum(np.bincount(np.asarray(self.matched_ends, dtype=np.int64), minlength=size))
+
+    def spanning(self, positions):
+        """Numbers of unclipped reads spanning each of the 1-based contig positions"""
+        if self.starts_upto is None:
+            self.build_spanning_index()
+        positions = np.asarray(positions, dtype=np.int64)
+        last = len(self.starts_upto) - 1
+        starts = np.where(positions < 1, 0, self.starts_upto[np.clip(positions - 1, 0, last)])
+        ends = np.where(positions < 0, 0, self.ends_upto[np.clip(positions, 0, last)])
+        return starts - ends
+
+    def num_spanning(self, last_matched):
+        """Number of unclipped reads spanning 1-based contig position last_matched"""
+        return int(self.spanning([last_matched])[0])
+
+    def coverage(self, last_matched, window):
+        """Numbers of unclipped reads spanning each position within window of last_matched"""
+        return [int(x) for x in self.spanning(range(last_matched - window, last_matched + window + 1))]
+
+def summarise_contigs(bam, contigs):
+    """Returns {contig: ContigReads} of the given contigs from one sequential pass over bam
+
+    The BAM file needs no index. When it is coordinate sorted the pass stops
+    after the last of the contigs.
+    """
+    summaries = dict((x, ContigReads()) for x in contigs)
+    by_tid = dict((bam.get_tid(x), summaries[x]) for x in summaries)
+    by_tid.pop(-1, None)
+    if not by_tid:
+        return summaries
+    last_tid = max(by_tid)
+    if bam.header.to_dict().get('HD', {}).get('SO') != 'coordinate':
+        last_tid = None
+    for read in bam.fetch(until_eof=True):
+        summary = by_tid.get(read.reference_id)
+        if summary is not None:
+            summary.add(read)
+        elif last_tid is not None and read.reference_id > last_tid:
+            break
+    return summaries
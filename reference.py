@@ -0,0 +1,64 @@
+"""Reference genome access used by KLEAT"""
+
+from collections import OrderedDict
+
+class ReferenceCache(object):
+    """Reference genome sequences served from a cache of fixed size blocks
+
+    Sequences are read from the FASTA file in aligned blocks (64kb by
+    default) which are kept in least recently used order, so the many
+    small overlapping windows fetched around neighbouring contigs of a
+    coordinate sorted alignment file are read from disk once.
+    fetch() behaves like pysam.FastaFile.fetch(reference, start, end).
+    """
+
+    def __init__(self, fasta, block_size=1<<16, maxblocks=256):
+        self.fasta = fasta
+        self.block_size = block_size
+        self.maxblocks = maxblocks
+        self.lengths = dict(zip(fasta.references, fasta.lengths))
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def references(self):
+        return self.fasta.references
+
+    def get_block(self, reference, i):
+        key = (reference, i)
+        try:
+            block = self.blocks.pop(key)
+            self.hits += 1
+        except KeyError:
+            block = self.fasta.fetch(reference, i * self.block_size, (i + 1) * self.block_size)
+            self.misses += 1
+            if len(self.blocks) >= self.maxblocks:
+                self.blocks.popitem(last=False)
+        self.blocks[key] = block
+        return block
+
+    def fetch(self, reference, start=None, end=None):
+        if reference not in self.lengths or start is None or end is None:
+            return self.fasta.fetch(reference, start, end)
+        if start < 0:
+            raise ValueError('start out of range ({})'.format(start))
+        if start > end:
+            raise ValueError('invalid coordinates: start ({}) > stop ({})'.format(start, end))
+        end = min(end, self.lengths[reference])
+        if start >= end:
+            return ''
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        offset = first * self.block_size
+        if first == last:
+            return self.get_block(reference, first)[start-offset:end-offset]
+        seq = ('').join([self.get_block(reference, i) for i in xrange(first, last + 1)])
+        return seq[start-offset:end-offset]
+
+    def reset_counts(self):
+        self.hits = self.misses = 0
+
+    def close(self):
+        self.blocks.clear()
+        self.fasta.close()
@@ -0,0 +1,703 @@
+"""Coordinate-centric KLEAT results
+
+Filters the contig-centric result lines with the bridge read alignments,
+groups them by cleavage site into the .KLEAT, .stats and track files, and
+reads and writes the partial results of --emit-partial runs so that runs
+over parts of a library can be merged (KLEAT_merge.py).
+"""
+
+import os
+import re
+import json
+import heapq
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+output_fields=['gene','transcript','transcript_strand','coding','contig','chromosome','cleavage_site','within_UTR','distance_from_annotated_site','ESTs','length_of_tail_in_contig','number_of_tail_reads','number_of_bridge_reads','max_bridge_read_tail_length','bridge_read_identities','tail+bridge_reads','number_of_link_pairs','max_link_pair_length','link_pair_identities','hexamer_loc+id','3UTR_start_end']
+
+PARTIAL_VERSION = 1
+
+def compare_chr(chr1, chr2):
+    """For sorting chromosome names ignoring 'chr'"""
+    if chr1[:3].lower() == 'chr':
+        chr1 = chr1[3:]
+    if chr2[:3].lower() == 'chr':
+        chr2 = chr2[3:]
+    
+    if re.match('^\d+$', chr1) and not re.match('^\d+$', chr2):
+        return -1
+    
+    elif not re.match('^\d+$', chr1) and re.match('^\d+$', chr2):
+        return 1
+    
+    else:
+        if re.match('^\d+$', chr1) and re.match('^\d+$', chr2):
+            chr1 = int(chr1)
+            chr2 = int(chr2)
+            
+        if chr1 < chr2:
+            return -1
+        elif chr1 > chr2:
+            return 1
+        else:
+            return 0
+
+def cantorPairing(a,b):
+    return (0.5*(a+b)*(a+b+1))+b
+
+def group_and_filter(lines_result, out_file, filters=None, make_track=None, rgb='0,0,0'):
+    #print 'grouping and filtering'
+    #print 'lines_result: {}'.format(lines_result)
+    global output_fields
+    hexamer_colours = ["255,0,0", "255,100,100", "255,150,150", "255,200,200",
+                       "0,255,0", "100,255,100", "150,255,150", "200,255,200",
+                       "0,0,255", "100,100,255", "150,150,255", "200,200,255",
+                       "255,0,255", "255,100,255", "255,150,255", "255,200,255"]
+    binding_sites = ['AATAAA','ATTAAA','AGTAAA','TATAAA',
+                     'CATAAA','GATAAA','AATATA','AATACA',
+                     'AATAGA','AAAAAG','ACTAAA','AAGAAA',
+                     'AATGAA','TTTAAA','AAAACA','GGGGCT']
+    """Consolidates contig-centric results into coordinate-centric results
+    
+    path = directory of tab-delimited results files
+    """
+    groups = {}
+    
+    lines_result = [x.split('\t') for x in lines_result.splitlines()]
+    for cols in lines_result:
+        chrom, cleavage_site = cols[5], cols[6]
+        if not groups.has_key(chrom):
+            groups[chrom] = {}
+        if not groups[chrom].has_key(cleavage_site):
+            groups[chrom][cleavage_site] = []
+        groups[chrom][cleavage_site].append(cols)
+            
+    stats = {'gene': {},
+             'transcript': {'coding': {}, 'noncoding':{}, 'unknown': {}},
+             'screened_out': 0,
+             'cleavage_site': 0,
+             'with_tail': 0,
+             'tail_and_bridge_and_link': 0,
+             'tail_and_bridge': 0,
+             'tail_and_link': 0,
+             'bridge_and_link': 0,
+             'just_tail': 0,
+             'just_bridge': 0,
+             'just_link': 0,
+             }
+            
+    out = open(out_file, 'w')
+    out.write('%s\n' % '\t'.join(output_fields))
+    
+    track_plus = []
+    track_minus = []
+    hexamers = []
+    utrs = []
+    uniqueutrs = set()
+    uniquehexamers = {}
+    for chrom in sorted(groups.keys(), cmp=compare_chr):
+        for cleavage in sorted(groups[chrom].keys()):
+            results = groups[chrom][cleavage]
+            # if more than one contig reports same cleavage site, add up the support numbers
+            if len(results) > 1:
+                result = merge_results(results)
+            else:
+                result = results[0]
+            if (result[10] != '-') and (result[12] != '-') and (result[16] != '-'):
+                if (int(result[10]) == 0) and (int(result[12]) == 0) and (int(result[16]) == 0):
+                    continue
+            
+            if ('-' not in [result[12],result[13]]):
+            #if (result[12] != '-'):
+                if (filters) and ('min_bridge_size' in filters) and ((int(result[12]) > 0) and (int(result[13]) < filters['min_bridge_size'])):
+                    continue
+                
+            out.write('%s\n' % '\t'.join(result))
+            if make_track is not None:
+                if result[2] == '+':
+                    track_plus.append(show_expression(result))
+                    for thing in show_hexamer(result,binding_sites,hexamer_colours):
+                        
+                        hexamers.append(thing)
+                else:
+                    track_minus.append(show_expression(result))
+                    for thing in show_hexamer(result,binding_sites,hexamer_colours):
+                        hexamers.append(thing)
+
+                utr = show_utr(result)
+                if utr:
+                    #print 'utr: {}'.format(utr)
+                    a,b = [int(x) for x in utr.split('\t')[1:3]]
+                    pairing = cantorPairing(a,b)
+                    if pairing not in uniqueutrs:
+                        utrs.append(utr)
+                        uniqueutrs.add(pairing)
+            
+            # stats
+            update_stats(stats, result)
+                
+    out.close()
+        
+    # prefix used for track and stats files
+    prefix = os.path.splitext(out_file)[0]
+    # output track
+    #randstr = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(10))
+    if make_track is not None:
+        track_file = prefix + '.bg'
+        output_track2(prefix+'.+.bg', make_track[0]+'.+', make_track[1], rgb, track_plus)
+        output_track2(prefix+'.-.bg', make_track[0]+'.-', make_track[1], rgb, track_minus)
+        output_hexamer(prefix + '.HEXAMERS.bed', hexamers)
+        output_track_utr(prefix+'.3UTR.bed', make_track[0]+'.3UTRs', make_track[1], rgb, utrs)
+        
+    # output stats file
+    stats_file = prefix + '.stats'
+    output_stats(stats, stats_file)
+
+def prepare_track_header(name, desc, rgb):
+    """Creates header for track"""
+    return 'track type=bedGraph name="%s" description="%s" visibility=full color=%s' % (name, desc, rgb)
+
+def output_hexamer(out_file, track=[]):
+    out = open(out_file, 'w')
+    out.write('track name="hexamer_track" description="Track containing all CPSF hexamer binding sites" visibility=2 itemRgb="On"\n')
+    for line in track:
+        out.write('%s\n' % line)
+    out.close()
+
+def output_track_utr(out_file, name, desc, rgb, track=[]):
+    out = open(out_file, 'w')
+    out.write('track name="{}" description="3\'UTR" visibility=full itemRgb="On"\n'.format(name, rgb))
+    for line in track:
+        out.write('{}\n'.format(line))
+
+def output_track2(out_file, name, desc, rgb, track=[]):
+    out = open(out_file, 'w')
+    out.write('track type=bedGraph name="{}" description="{}" visibility=full color={}\n'.format(name, desc, rgb))
+    for line in track:
+        out.write('{}\n'.format(line))
+
+def merge_results(results):        
+    """Merges results from different contigs of same cleavage site into single result"""
+    # join fields: contig, bridge_name, link_name, tail_coverage (with --tail_coverage)
+    join = [4, 14, 18, 21]              
+    # add fields: num_tail_reads, num_bridge_reads, tail+bridge, num_link_pairs
+    add = [11, 12, 15, 16]
+    # max fields: tail_len, bridge_len, link_len
+    biggest = [10, 13, 17]
+    
+    merged = []
+    for i in range(len(results[0])):
+        if i in add:
+            data = [int(r[i]) for r in results if r[i].isdigit()]
+            if data:
+                merged.append(str(sum(data)))
+            else:
+                merged.append('-')              
+        elif i in biggest:
+            data = [int(r[i]) for r in results if r[i].isdigit()]
+            if data:
+                merged.append(str(max(data)))
+            else:
+                merged.append('-')              
+        elif i in join:
+            data = [r[i] for r in results if r[i] != '-']
+            
+            # if there is data other than '-', then list all items
+            if data:
+                merged.append(','.join([r[i] for r in results if r[i] != '-']))
+            else:
+                merged.append('-')                  
+        else:
+            merged.append(results[0][i])
+
+    return merged
+
+def update_stats(stats, result):
+    """Updates summary stats with result
+    
+    stats = dictionary of final stats results
+    result = list of values of each output line
+    """
+    has_tail = has_bridge = has_link = False
+    if result[10].isdigit() and int(result[10]) > 0:
+        has_tail = True
+    if result[12].isdigit() and int(result[12]) > 0:
+        has_bridge = True
+    if result[16].isdigit() and int(result[16]) > 0:
+        has_link = True
+        
+    if not (has_tail or has_bridge or has_link):
+        return
+        
+    stats['cleavage_site'] += 1
+    
+    if not stats['gene'].has_key(result[0]):
+        stats['gene'][result[0]] = 0
+    stats['gene'][result[0]] += 1
+    
+    if result[3] == 'yes':
+        stats['transcript']['coding'][result[1]] = True
+    elif result[3] == 'no':
+        stats['transcript']['noncoding'][result[1]] = True
+    else:
+        stats['transcript']['unknown'][result[1]] = True
+                        
+    if has_tail and has_bridge and has_link:
+        stats['tail_and_bridge_and_link'] += 1
+    elif has_tail and has_bridge:
+        stats['tail_and_bridge'] += 1
+    elif has_bridge and has_link:
+        stats['bridge_and_link'] += 1
+    elif has_tail and has_link:
+        stats['tail_and_link'] += 1
+    elif has_tail:
+        stats['just_tail'] += 1
+    elif has_bridge:
+        stats['just_bridge'] += 1
+    elif has_link:
+        stats['just_link'] += 1
+
+def output_stats(stats, out_file):
+    """Outputs stats data into output file"""
+    out = open(out_file, 'w')
+    out.write('total cleavage sites: %d\n' % stats['cleavage_site'])
+    out.write('cleavage sites with tail, bridge, link support: %d\n' % stats['tail_and_bridge_and_link'])
+    out.write('cleavage sites with tail, bridge support: %d\n' % stats['tail_and_bridge'])
+    out.write('cleavage sites with tail, link support: %d\n' % stats['tail_and_link'])
+    out.write('cleavage sites with bridge, link support: %d\n' % stats['bridge_and_link'])
+    out.write('cleavage sites with only tail support: %d\n' % stats['just_tail'])
+    out.write('cleavage sites with only bridge support: %d\n' % stats['just_bridge'])
+    out.write('cleavage sites with only link support: %d\n' % stats['just_link'])
+    out.write('total genes: %d\n' % len(stats['gene'].keys()))
+    try:
+        out.write('average cleavage sites per gene: %.1f\n' % (float(stats['cleavage_site'])/len(stats['gene'].keys())))
+    except ZeroDivisionError:
+        out.write('average cleavage sites per gene: error')
+    out.write('total transcripts: %d\n' % (len(stats['transcript']['coding'].keys()) + len(stats['transcript']['noncoding'].keys())))
+    out.write('total coding transcripts: %d\n' % len(stats['transcript']['coding'].keys()))
+    out.write('total noncoding transcripts: %d\n' % len(stats['transcript']['noncoding'].keys()))
+    out.close()
+
+def show_expression(result):
+    """Creates bed-graph line depicting expression of cleavage site"""
+    return '%s\t%s\t%s\t%s' % (result[5], int(result[6]) - 1, result[6], result[15])
+
+def show_hexamer(result, binding_sites, rbgs):
+    r = []
+    sites = result[19].split(';')
+    sites = [x.split(':') for x in sites]
+    for site in reversed(sites):
+        if len(site) < 2:
+            break
+        if result[2] == '+':
+            r.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], site[0], int(site[0])+6, binding_sites[int(site[1])-1], int(site[1])*62.5, result[2], site[0], int(site[0])+6, rbgs[int(site[1])-1]))
+        else:
+            r.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], int(site[0])-6, site[0], binding_sites[int(site[1])-1], int(site[1])*62.5, result[2], int(site[0])-6, site[0], rbgs[int(site[1])-1]))
+    return r
+
+def show_utr(result):
+#    print 'show_utr'
+#    print 'result: {}'.format(result)
+    if result[20] == '-':
+        return None
+    start, end = result[20].split('-')
+    if (start == 'None') or (end == 'None'):
+        return None
+    rgb='255,0,0'
+    if result[20][0] == 'N':
+        start = start[1:]
+        rgb='0,255,0'
+    #if result[2] == '-':
+    #    times[key].append(time.time()-start)
+    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], end, start, result[4], 0, result[2], end, start, rgb)
+    #else:
+    #    times[key].append(time.time()-start)
+    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], start, end, result[4], 0, result[2], start, end, rgb)
+    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(result[5], start, end, result[4], 0, result[2], start, end, rgb)
+
+def calcScore(match, mismatch, qnuminsert, tnuminsert):
+    return int(match) - int(mismatch) - int(qnuminsert) - int(tnuminsert)
+
+def psl_alignments(aln_file):
+    """Yields the columns of each alignment line of a PSL file"""
+    with open(aln_file, 'r') as f:
+        for line in f:
+            if not line[:1].isdigit():
+                continue
+            yield line.rstrip('\n').split('\t')
+
+def is_full_single_block(cols):
+    """Whether a PSL alignment covers its whole query in a single block"""
+    return int(cols[11]) == 0 and int(cols[10]) == int(cols[12]) and int(cols[17]) == 1
+
+class BridgeReadHits(object):
+    """Summary of the genome alignments of a bridge read, as filter_bridge_reads looks at them
+
+    local = {(target, cleavage site): best score of the alignments to target
+             ending at the cleavage site}, for the sites the read is reported at
+    best, best_target = best score of the full single block alignments, and its target
+    other = best score of the full single block alignments to other targets than best_target
+    """
+    __slots__ = ('local', 'best', 'best_target', 'other')
+
+    def __init__(self):
+        self.local = {}
+        self.best = self.best_target = self.other = None
+
+    def add_full(self, target, score):
+        """Adds a full single block alignment"""
+        if self.best is None or score > self.best:
+            if target != self.best_target:
+                # the previous best is the best elsewhere than the new target
+                self.other = self.best
+            self.best, self.best_target = score, target
+        elif target != self.best_target and (self.other is None or score > self.other):
+            self.other = score
+
+    def nonlocal_score(self, target):
+        """Best score of the full single block alignments to other targets than target, None if there are none"""
+        if target == self.best_target:
+            return self.other
+        return self.best
+
+def bridge_read_queries(lines_result, queries=None):
+    """What the bridge read filters look up for each bridge read of the result lines
+
+    Returns {read: [set of (chromosome, cleavage site), set of transcripts]},
+    adding to queries if given
+    """
+    if queries is None:
+        queries = {}
+    for result in lines_result:
+        result = result.split('\t')
+        if result[14] == '-':
+            continue
+        for read in result[14].split(','):
+            if read not in queries:
+                queries[read] = [set(), set()]
+            queries[read][0].add((result[5], int(result[6])))
+            queries[read][1].add(result[1])
+    return queries
+
+def summarise_genome_alignments(aln_file, queries):
+    """Folds the genome alignments of the reads in queries into a BridgeReadHits per read, as they are read
+
+    Memory is bounded by queries however many alignments a read has.
+    Reads without alignments are left out.
+    """
+    hits = {}
+    for cols in psl_alignments(aln_file):
+        query = cols[9]
+        if query not in queries:
+            continue
+        if query not in hits:
+            hits[query] = BridgeReadHits()
+        read = hits[query]
+        target = cols[13]
+        score = calcScore(cols[0],cols[1],cols[4],cols[6])
+        site = (target, int(cols[16]))
+        if site in queries[query][0] and (site not in read.local or score > read.local[site]):
+            read.local[site] = score
+        if is_full_single_block(cols):
+            read.add_full(target, score)
+    return hits
+
+def summarise_transcript_alignments(aln_file, queries):
+    """{read: transcripts of queries the read aligns to in full in a single block}, as they are read
+
+    Reads without alignments are left out.
+    """
+    hits = {}
+    for cols in psl_alignments(aln_file):
+        query = cols[9]
+        if query not in queries:
+            continue
+        if query not in hits:
+            hits[query] = set()
+        if cols[13] in queries[query][1] and is_full_single_block(cols):
+            hits[query].add(cols[13])
+    return hits
+
+def filter_contig_sites(contig_sites):
+    """Drops contig sites within 20 bases of the previous site kept
+
+    contig_sites are (cleavage_site, result line) pairs
+    """
+    contig_sites = sorted(contig_sites, key=lambda x: x[0])
+    res = [contig_sites[0]]
+    for event in contig_sites[1:]:
+        if (abs(event[0] - res[-1][0]) > 20):
+            res.append(event)
+    return res
+
+def filter_bridge_reads(lines_result, blat_genome_results, blat_transcript_results):
+    """Removes bridge reads that align better elsewhere in the genome or within the transcript
+
+    blat_genome_results and blat_transcript_results are the alignment
+    summaries of summarise_genome_alignments and summarise_transcript_alignments.
+    Returns the result lines that still have tail or bridge read support
+    """
+    keep = []
+    #print 'lines_result before: {}'.format(lines_result)
+    for result in lines_result:
+        result = result.split('\t')
+        target = result[5]
+        transcript = result[1]
+        cleavage_site = int(result[6])
+        bridge_reads = result[14].split(',')
+        temp = bridge_reads[:]
+        has_tail = (result[10] != '0')
+        if (bridge_reads == ['-']): 
+            if (has_tail):
+                keep.append(('\t').join(result))
+                continue
+            else:
+                continue
+        for read in temp:
+            remove_read = False
+            if read not in blat_genome_results:
+                continue
+            if read == '-':
+                continue
+            #print 'Looking at read {}'.format(read)
+            hits = blat_genome_results[read]
+            # Best score of the alignments to the target ending at the cleavage
+            # site, none if the read has no such alignment and is to be removed,
+            # and of the full single block alignments to other targets
+            maxlocal = hits.local.get((target, cleavage_site))
+            maxnonlocal = hits.nonlocal_score(target)
+            has_target_aln = maxlocal is not None
+            if ((maxnonlocal and maxlocal) and (maxnonlocal > maxlocal)) or not (has_target_aln):
+                remove_read = True
+            # Check transcript alignments
+            if read not in blat_transcript_results:
+                continue
+            elif transcript in blat_transcript_results[read]:
+                remove_read = True
+            if remove_read:
+                temp.remove(read)
+                result[13] = '-'
+                result[15] = str(int(result[15]) - 1)
+        if not temp and not has_tail:
+            continue
+        elif temp and temp != ['-']:
+            result[14] = (',').join(temp)
+            result[12] = str(len(temp))
+        else:
+            result[14] = '-'
+            result[12] = '0'
+        keep.append(('\t').join(result))
+    return keep
+
+def run_blat(database, queries, out_file):
+    FNULL = open(os.devnull, 'w')
+    task = subprocess.Popen(['blat', database, queries, out_file], stdout=FNULL)
+    task.communicate()
+    FNULL.close()
+
+def split_fasta(fasta, num_chunks):
+    """Splits a FASTA file into at most num_chunks files of consecutive records
+
+    Chunks get about the same number of bases. Returns the chunk files,
+    named <fasta>.<chunk number>
+    """
+    records = list(read_fasta(fasta))
+    total = sum(len(x[1]) for x in records)
+    chunks = []
+    out, size = None, 0
+    for name, seq in records:
+        # start the next chunk when this one has its share of the bases
+        if out is None or (size >= total * len(chunks) / num_chunks and len(chunks) < num_chunks):
+            if out is not None:
+                out.close()
+            chunks.append('{}.{}'.format(fasta, len(chunks)))
+            out = open(chunks[-1], 'w')
+        out.write('>{}\n{}\n'.format(name, seq))
+        size += len(seq)
+    if out is not None:
+        out.close()
+    return chunks
+
+def merge_psl(chunk_files, out_file):
+    """Concatenates the PSL files of chunks into out_file, keeping the header of the first
+
+    The chunk files are removed.
+    """
+    with open(out_file, 'w') as out:
+        for i, chunk_file in enumerate(chunk_files):
+            with open(chunk_file, 'r') as f:
+                for line in f:
+                    if i == 0 or re.search('^\d', line):
+                        out.write(line)
+            os.remove(chunk_file)
+
+def run_blat_chunks(searches, queries, threads):
+    """Runs BLAT searches of the same queries on chunks of them, threads at a time
+
+    searches are (database, out_file) pairs. The queries are split into
+    threads chunks, each search of each chunk is its own blat process, and
+    the PSL files of the chunks are merged into the out_file of the search
+    in chunk order, so the alignments of each query keep their order.
+    """
+    chunks = split_fasta(queries, threads)
+    jobs = [(database, chunk, '{}.{}'.format(out_file, i)) for database, out_file in searches for i, chunk in enumerate(chunks)]
+    # the work is done by the blat processes, threads only wait for them
+    pool = ThreadPool(threads)
+    try:
+        pool.map(lambda job: run_blat(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
+        for chunk in chunks:
+            os.remove(chunk)
+    for database, out_file in searches:
+        merge_psl(['{}.{}'.format(out_file, i) for i in range(len(chunks))], out_file)
+
+def report_results(lines_result, contig_sites, potential_bridges, transcript_seqs, ref_genome, out, filters=None, make_track=None, rgb='0,0,0', blat_threads=1):
+    """Filters bridge reads and writes the .KLEAT, .stats and track files
+
+    lines_result = contig-centric result lines
+    contig_sites = (cleavage_site, result line) pairs of transcript ends reached by contigs
+    potential_bridges = FASTA file of the potential bridge reads
+    transcript_seqs = FASTA file of the transcripts reported with bridge reads, removed when done
+    blat_threads = number of BLAT processes run at once (align_bridge_reads)
+    """
+    blat_results = align_bridge_reads(potential_bridges, transcript_seqs, ref_genome, os.path.dirname(out),
+                                      bridge_read_queries(lines_result), threads=blat_threads)
+    write_results(lines_result, contig_sites, blat_results, out, filters=filters, make_track=make_track, rgb=rgb)
+
+def align_bridge_reads(potential_bridges, transcript_seqs, ref_genome, basedir, queries, threads=1):
+    """Aligns the potential bridge reads against the genome and the transcripts
+
+    With threads > 1 the reads are split into that many chunks and the
+    chunks of both searches are aligned threads at a time (run_blat_chunks).
+    Returns the summaries of the genome and the transcript alignments of
+    the reads in queries (bridge_read_queries) the bridge read filters need.
+    transcript_seqs is removed when done.
+    """
+    #bstart = [time.time(),time.strftime("%c")]
+    blat_alignment = os.path.join(basedir,'.bridge_to_genome')
+    blat_alignment2 = os.path.join(basedir,'.bridge_to_transcripts')
+    if threads > 1:
+        print "Aligning bridge reads against genome and transcripts in {} chunks...".format(threads)
+        run_blat_chunks([(ref_genome, blat_alignment), (transcript_seqs, blat_alignment2)], potential_bridges, threads)
+        print "Blat alignment complete"
+    else:
+        print "Aligning bridge reads against genome..."
+        run_blat(ref_genome, potential_bridges, blat_alignment)
+        print "Blat alignment complete"
+        print "Aligning bridge reads against transcripts..."
+        run_blat(transcript_seqs, potential_bridges, blat_alignment2)
+        print "Blat alignment complete"
+    print 'getting genome blat results...'
+    blat_genome_results = summarise_genome_alignments(blat_alignment, queries)
+    print 'Done!'
+    print 'getting transcript blat results...'
+    blat_transcript_results = summarise_transcript_alignments(blat_alignment2, queries)
+    print 'Done!'
+    print 'Removing temp files...'
+    os.remove(blat_alignment)
+    os.remove(blat_alignment2)
+    os.remove(transcript_seqs)
+    return blat_genome_results, blat_transcript_results
+
+def write_results(lines_result, contig_sites, blat_results, out, filters=None, make_track=None, rgb='0,0,0'):
+    """Filters bridge reads with the summaries of their alignments (blat_results) and writes the .KLEAT, .stats and track files"""
+    keep = filter_bridge_reads(lines_result, blat_results[0], blat_results[1])
+    if contig_sites:
+        contig_sites = filter_contig_sites(contig_sites)
+    lines_result = ('\n').join(keep + [x[1] for x in contig_sites])
+    group_and_filter(lines_result, out+'.KLEAT', filters=filters, make_track=make_track, rgb=rgb)
+
+def result_key(line):
+    """Sort key of a result line: chromosome and cleavage site"""
+    cols = line.split('\t')
+    return cols[5], int(cols[6])
+
+def read_fasta(fasta):
+    """Yields (name, sequence) of the records of a FASTA file"""
+    name, seq = None, []
+    with open(fasta, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ('').join(seq)
+                name, seq = line[1:], []
+            else:
+                seq.append(line)
+    if name is not None:
+        yield name, ('').join(seq)
+
+def write_partial(out_file, params, order, lines_result, contig_sites, potential_bridges, transcripts):
+    """Writes the results of a run that are needed to finish it with other runs
+
+    The file starts with the run parameters and the position of the run
+    in the genome (order), followed by records sorted within their kind:
+    R   contig-centric result line, by chromosome and cleavage site
+    S   contig site result line, by cleavage site
+    B   potential bridge read name and sequence, by name
+    T   transcript id and sequence, by id
+    """
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as out:
+        out.write('##kleat_partial={}\n'.format(PARTIAL_VERSION))
+        out.write('##params={}\n'.format(json.dumps(params, sort_keys=True)))
+        out.write('##order={}\n'.format(json.dumps(order)))
+        for line in sorted(lines_result, key=result_key):
+            out.write('R\t{}\n'.format(line))
+        for cleavage_site, line in sorted(contig_sites, key=lambda x: x[0]):
+            out.write('S\t{}\n'.format(line))
+        for name, seq in sorted(set(read_fasta(potential_bridges))):
+            out.write('B\t{}\t{}\n'.format(name, seq))
+        for tid, seq in sorted(set(transcripts)):
+            out.write('T\t{}\t{}\n'.format(tid, seq))
+    os.rename(tmp_file, out_file)
+
+class Partial(object):
+    """Partial results written by a KLEAT --emit-partial run"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r') as f:
+            header = [f.readline().rstrip('\n') for i in range(3)]
+        if header[0] != '##kleat_partial={}'.format(PARTIAL_VERSION):
+            raise ValueError('{} is not a version {} KLEAT partial results file'.format(path, PARTIAL_VERSION))
+        self.params = json.loads(header[1][len('##params='):])
+        self.order = json.loads(header[2][len('##order='):])
+
+    def records(self, kind):
+        """Yields the records of one kind without their kind column"""
+        prefix = kind + '\t'
+        seen = False
+        with open(self.path, 'r') as f:
+            for line in f:
+                if line.startswith(prefix):
+                    seen = True
+                    yield line[len(prefix):].rstrip('\n')
+                elif seen:
+                    break
+
+def merge_partials(partials, potential_bridges, transcript_seqs):
+    """K-way merges partial results
+
+    partials are in genome order, records with equal keys keep that order
+    so the merged results match those of a single run over the genome.
+    Writes the potential bridge reads and transcripts to FASTA files and
+    returns the result lines and (cleavage_site, line) contig sites.
+    """
+    def decorate(i, partial, kind, key):
+        for j, line in enumerate(partial.records(kind)):
+            yield key(line), i, j, line
+    lines_result = [x[-1] for x in heapq.merge(*[decorate(i, p, 'R', result_key) for i, p in enumerate(partials)])]
+    contig_sites = [(x[0], x[-1]) for x in heapq.merge(*[decorate(i, p, 'S', lambda x: int(x.split('\t')[6])) for i, p in enumerate(partials)])]
+    for kind, out_file in (('B', potential_bridges), ('T', transcript_seqs)):
+        with open(out_file, 'w') as out:
+            last = None
+            for record in heapq.merge(*[p.records(kind) for p in partials]):
+                if record == last:
+                    continue
+                name, seq = record.split('\t')
+                out.write('>{}\n{}\n'.format(name, seq))
+                last = record
+    return lines_result, contig_sites
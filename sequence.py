@@ -0,0 +1,40 @@
+"""Reverse complement of nucleotide sequences with a translation table
+
+Covers the IUPAC nucleotide codes in either case (U complements to A).
+Sequences are complemented with str.translate and reversed with a slice;
+many sequences are joined and complemented at once by reverse_complements.
+Characters outside the IUPAC alphabet raise a ValueError.
+"""
+
+import string
+
+IUPAC = 'ACGTUNRYSWKMBDHV'
+COMPLEMENTS = 'TGCAANYRSWMKVHDB'
+# Separator of the sequences complemented together
+SEPARATOR = '\n'
+
+COMPLEMENT = string.maketrans(IUPAC + IUPAC.lower(), COMPLEMENTS + COMPLEMENTS.lower())
+# Complements in upper case, as KLEAT's revComp gives them
+COMPLEMENT_UPPER = string.maketrans(IUPAC + IUPAC.lower(), COMPLEMENTS + COMPLEMENTS)
+
+def check_alphabet(seq, allowed=''):
+    """Raises a ValueError if seq has characters other than IUPAC codes and allowed"""
+    invalid = seq.translate(None, IUPAC + IUPAC.lower() + allowed)
+    if invalid:
+        raise ValueError('Not a nucleotide: {!r}'.format(invalid[0]))
+
+def reverse_complement(seq, upper=False):
+    """Reverse complement of seq, in upper case if upper, otherwise in the case of seq"""
+    check_alphabet(seq)
+    return seq.translate(COMPLEMENT_UPPER if upper else COMPLEMENT)[::-1]
+
+def reverse_complements(seqs, upper=False):
+    """Reverse complement of each sequence in seqs, translated at once"""
+    if not seqs:
+        return []
+    joined = SEPARATOR.join(seqs)
+    check_alphabet(joined, SEPARATOR)
+    # reversing the joined sequences also reverses their order
+    result = joined.translate(COMPLEMENT_UPPER if upper else COMPLEMENT)[::-1].split(SEPARATOR)
+    result.reverse()
+    return result
@@ -0,0 +1,117 @@
+"""Sidecar of a reads-to-contigs alignment holding only what KLEAT looks at
+
+KLEAT only looks at the spans of the reads aligned to a contig without
+clipping and at the reads with one clipped end. KLEAT_extract.py decodes
+the alignment once into a ContigReads summary per contig and writes them
+to a sidecar file, which later runs on the same library read with
+--sidecar instead of the BAM file.
+
+The file starts with the header of signedfile.py (version and signature
+of the alignment file) and holds the zlib compressed summary of each contig, followed by an
+index of where each summary is and how many clipped reads it has, and a
+trailer giving the position of the index.
+"""
+
+import os
+import zlib
+import struct
+import cPickle
+
+import pysam
+
+from signedfile import write_header, read_header, atomic_write, VersionMismatch, SourceChanged
+from readsummary import ContigReads
+
+SIDECAR_VERSION = 2
+SIDECAR_SUFFIX = '.kleat_reads'
+MAGIC = 'KLEATRDS'
+# index position, index size, magic
+TRAILER = struct.Struct('<QQ8s')
+
+class SidecarError(Exception):
+    pass
+
+def default_sidecar_path(r2c):
+    return r2c + SIDECAR_SUFFIX
+
+def write_sidecar(path, r2c, level=6):
+    """Writes the read summaries of all contigs of the alignment file r2c to path
+
+    The alignment file must be sorted by contig. Returns the number of
+    contigs with reads.
+    """
+    bam = pysam.AlignmentFile(r2c, 'rb')
+    index = {}
+    try:
+        with atomic_write(path) as out:
+            write_header(out, SIDECAR_VERSION, r2c)
+
+            def write_summary(tid, summary):
+                contig = bam.getrname(tid)
+                if contig in index:
+                    raise SidecarError('{} is not sorted by contig'.format(r2c))
+                data = zlib.compress(cPickle.dumps(summary, cPickle.HIGHEST_PROTOCOL), level)
+                index[contig] = (out.tell(), len(data), len(summary.clipped))
+                out.write(data)
+
+            tid, summary = None, None
+            for read in bam.fetch(until_eof=True):
+                if read.reference_id < 0:
+                    continue
+                if read.reference_id != tid:
+                    if summary:
+                        write_summary(tid, summary)
+                    tid, summary = read.reference_id, ContigReads()
+                summary.add(read)
+            if summary:
+                write_summary(tid, summary)
+
+            data = zlib.compress(cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL), level)
+            offset = out.tell()
+            out.write(data)
+            out.write(TRAILER.pack(offset, len(data), MAGIC))
+    finally:
+        bam.close()
+    return len(index)
+
+class ReadsSidecar(object):
+    """Reader of a sidecar file
+
+    If r2c is given the sidecar must have been extracted from that file.
+    """
+
+    def __init__(self, path, r2c=None):
+        self.path = path
+        try:
+            self.handle = open(path, 'rb')
+            self.r2c = read_header(self.handle, SIDECAR_VERSION, r2c)
+            self.handle.seek(-TRAILER.size, os.SEEK_END)
+            offset, size, magic = TRAILER.unpack(self.handle.read(TRAILER.size))
+            if magic != MAGIC:
+                raise SidecarError('{} is not a complete sidecar file'.format(path))
+            self.handle.seek(offset)
+            self.index = cPickle.loads(zlib.decompress(self.handle.read(size)))
+        except VersionMismatch:
+            raise SidecarError('{} is from another version'.format(path))
+        except SourceChanged:
+            raise SidecarError('{} changed since {} was extracted'.format(r2c, path))
+        except (IOError, EOFError, KeyError, cPickle.UnpicklingError, zlib.error, struct.error) as err:
+            raise SidecarError('Could not read sidecar {} ({})'.format(path, err))
+
+    def __contains__(self, contig):
+        return contig in self.index
+
+    def get(self, contig):
+        """Read summary of contig, empty if no read is aligned to it"""
+        if contig not in self.index:
+            return ContigReads()
+        offset, size, clipped = self.index[contig]
+        self.handle.seek(offset)
+        return cPickle.loads(zlib.decompress(self.handle.read(size)))
+
+    def clip_counts(self):
+        """{contig: number of reads with one clipped end}, as prescreen.count_clipped_reads counts them"""
+        return dict((contig, x[2]) for contig, x in self.index.iteritems() if x[2])
+
+    def close(self):
+        self.handle.close()
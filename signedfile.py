@@ -0,0 +1,119 @@
+"""Binary files tied to the file they were made from
+
+The annotation cache, the clipped read index and the reads sidecar start
+with a pickled header holding the version of their layout and the
+signature (path, size, mtime and content hash) of the file they were made
+from, and are stale when either changed. They are written to a temporary
+file renamed into place, so that an interrupted write leaves no partial
+file behind.
+"""
+
+import os
+import hashlib
+import logging
+import cPickle
+from contextlib import contextmanager
+
+logger = logging.getLogger('polyA_logger')
+
+class StaleFileError(Exception):
+    pass
+
+class VersionMismatch(StaleFileError):
+    pass
+
+class SourceChanged(StaleFileError):
+    pass
+
+def file_digest(path, blocksize=1 << 20):
+    """Returns the sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            digest.update(block)
+            block = f.read(blocksize)
+    return digest.hexdigest()
+
+def file_signature(path, digest=True):
+    """Identifies a version of a file by its path, size, mtime and content hash"""
+    st = os.stat(path)
+    sig = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+    if digest:
+        sig['sha1'] = file_digest(path)
+    return sig
+
+def signature_matches(cached, path):
+    """Checks whether a cached file signature still describes the file at path
+
+    Size must always agree. If the mtime differs as well (eg. the file was
+    copied or touched) the contents are hashed and compared instead.
+    """
+    current = file_signature(path, digest=False)
+    if cached.get('size') != current['size']:
+        return False
+    if cached.get('mtime') == current['mtime']:
+        return True
+    return cached.get('sha1') == file_digest(path)
+
+def write_header(f, version, source):
+    """Writes the header of a file made from source with layout version"""
+    cPickle.dump({'version': version, 'source': file_signature(source)}, f, cPickle.HIGHEST_PROTOCOL)
+
+def read_header(f, version, source=None):
+    """Reads the header written by write_header and returns the signature of the source in it
+
+    Raises VersionMismatch if the layout version differs, and
+    SourceChanged if source is given and no longer matches the signature.
+    """
+    header = cPickle.load(f)
+    if not isinstance(header, dict) or header.get('version') != version:
+        raise VersionMismatch()
+    if source is not None and not signature_matches(header['source'], source):
+        raise SourceChanged()
+    return header['source']
+
+@contextmanager
+def atomic_write(path):
+    """Yields a file to write instead of path, renamed to path if the block completes"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as out:
+            yield out
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_signed_pickle(path, version, source, label):
+    """Returns the object pickled in path after its header, or None if path is missing or stale
+
+    label names the file in log messages, eg. 'Annotation cache'.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            read_header(f, version, source)
+            return cPickle.load(f)
+    except VersionMismatch:
+        logger.info('%s %s is from another version, rebuilding', label, path)
+    except SourceChanged:
+        logger.info('%s changed since %s %s was written, rebuilding', source, label.lower(), path)
+    except (EOFError, IOError, cPickle.UnpicklingError, KeyError, AttributeError, ValueError) as err:
+        logger.info('Could not read %s %s (%s), rebuilding', label.lower(), path, err)
+    return None
+
+def write_signed_pickle(path, version, source, obj, label):
+    """Writes obj to path after a header tied to source, replacing any previous file atomically
+
+    Returns whether it was written, label names the file in log messages.
+    """
+    try:
+        with atomic_write(path) as out:
+            write_header(out, version, source)
+            cPickle.dump(obj, out, cPickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError) as err:
+        logger.warning('Could not write %s %s: %s', label.lower(), path, err)
+        return False
+    return True